@@ -16,6 +16,10 @@ import getpass
 import pwd
 import grp
 import tempfile
+import re
+import time
+import statistics
+import concurrent.futures
 from datetime import datetime
 
 # --- Attempt to import required libraries ---
@@ -33,6 +37,19 @@ SERVICE_GROUP = "yui-bot"
 ENV_PERMS = 0o640 # rw-r----- (Octal)
 DEFAULT_TIMEOUT_SECS = "3600"
 DEFAULT_MODEL_NAME = "gemini-1.5-flash"
+# --benchmark-models: a small fixed prompt set, similar to what the bot is asked
+BENCHMARK_PROMPTS = [
+    "In two sentences, what does the Unix command 'grep -r' do?",
+    "Write a short, friendly reply to someone who said 'good morning' in a Discord channel.",
+    "List three differences between TCP and UDP as brief bullet points.",
+    "Explain what a Python context manager is, with a three-line example.",
+]
+DEFAULT_BENCHMARK_CONCURRENCY = 4
+DEFAULT_BENCHMARK_MAX_ERROR_RATE = 0.25 # "Acceptable" models fail at most this share of prompts
+BENCHMARK_RATE_LIMIT_RETRIES = 3 # ResourceExhausted (per-minute quota) is retried, not counted as a model error
+BENCHMARK_RATE_LIMIT_BACKOFF_SECS = 5.0 # Doubled on each retry
+BENCHMARK_FALLBACK_COUNT = 3
+BENCHMARK_SKIP_PATTERN = re.compile(r"exp|preview|tts|image|embedding|live|thinking|vision") # Unsuited to chat by default
 
 # --- Privilege Check ---
 def check_privileges():
@@ -61,12 +78,12 @@ def get_service_ids():
         print(f"Error getting service UID/GID: {e}", file=sys.stderr); sys.exit(1)
 
 # --- Fetch Available Models ---
-def get_available_models(api_key):
-    """Connects to Gemini API and returns list of usable model names."""
+def get_available_models(api_key, client=genai):
+    """Connects to Gemini API and returns list of usable model names. 'client' may be a stub of the genai module."""
     print("--> Verifying API key and fetching available models...")
     try:
-        genai.configure(api_key=api_key)
-        models = genai.list_models()
+        client.configure(api_key=api_key)
+        models = client.list_models()
         usable_models = sorted([m.name for m in models if 'generateContent' in m.supported_generation_methods])
         if not usable_models:
             print("Error: No models supporting content generation found with this API key.", file=sys.stderr)
@@ -81,6 +98,92 @@ def get_available_models(api_key):
     except Exception as e:
         return None, f"Unexpected error connecting to Gemini API: {type(e).__name__}"
 
+# --- Model Latency Benchmark (--benchmark-models) ---
+def default_benchmark_candidates(model_ids):
+    """Picks stable chat-capable Gemini models to benchmark; falls back to all of them."""
+    candidates = [m for m in model_ids if m.startswith("gemini-") and not BENCHMARK_SKIP_PATTERN.search(m)]
+    return candidates or list(model_ids)
+
+def benchmark_prompt(model_name, prompt, client=genai, sleep=time.sleep):
+    """Streams one prompt and returns its timings: time to first token, generation time, output tokens, error.
+
+    Rate limit errors (ResourceExhausted) are retried with backoff; if they persist the result is marked
+    'rate_limited', which says nothing about the model and is left out of its error rate.
+    """
+    result = {'model': model_name, 'ttft': None, 'seconds': 0.0, 'tokens': 0, 'error': None, 'rate_limited': False}
+    for attempt in range(BENCHMARK_RATE_LIMIT_RETRIES + 1):
+        started = time.perf_counter() # Backoff waits are not part of the timings
+        result.update(ttft=None, tokens=0, error=None, rate_limited=False)
+        try:
+            response = client.GenerativeModel(model_name).generate_content(prompt, stream=True)
+            text_chars = 0
+            for chunk in response:
+                if result['ttft'] is None: result['ttft'] = time.perf_counter() - started
+                text_chars += len(getattr(chunk, 'text', '') or '')
+                usage = getattr(chunk, 'usage_metadata', None)
+                if usage is not None and getattr(usage, 'candidates_token_count', 0): result['tokens'] = usage.candidates_token_count
+            result['tokens'] = result['tokens'] or text_chars // 4 # ~4 chars/token if usage is not reported
+            result['seconds'] = time.perf_counter() - started
+            if result['ttft'] is None: result['error'] = "empty response"
+            return result
+        except google_api_exceptions.ResourceExhausted as e:
+            result.update(error=f"{type(e).__name__}: {e}", rate_limited=True)
+            if attempt < BENCHMARK_RATE_LIMIT_RETRIES: sleep(BENCHMARK_RATE_LIMIT_BACKOFF_SECS * 2 ** attempt)
+        except Exception as e: # Unsupported models, network errors: these count against the model
+            result.update(ttft=None, error=f"{type(e).__name__}: {e}")
+            result['seconds'] = time.perf_counter() - started
+            return result
+    return result
+
+def benchmark_models(model_names, prompts=BENCHMARK_PROMPTS, concurrency=DEFAULT_BENCHMARK_CONCURRENCY, client=genai, sleep=time.sleep):
+    """Benchmarks one model at a time (its prompts at most 'concurrency' at once) and summarizes each model.
+
+    Models run as separate groups so they don't compete for the key's rate limit or skew each other's TTFT.
+    """
+    runs = {name: [] for name in model_names}
+    total = len(model_names) * len(prompts); done = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+        for name in model_names:
+            futures = [executor.submit(benchmark_prompt, name, prompt, client, sleep) for prompt in prompts]
+            for future in concurrent.futures.as_completed(futures):
+                runs[name].append(future.result()); done += 1
+                print(f"\r--> Benchmarking {name}: {done}/{total} requests done", end="", flush=True)
+    print()
+    summaries = []
+    for name, results in runs.items():
+        measured = [r for r in results if not r['rate_limited']] # Rate limits are the key's, not the model's
+        ok = [r for r in measured if not r['error']]
+        generation_seconds = sum(r['seconds'] - r['ttft'] for r in ok)
+        summaries.append({
+            'model': name,
+            'ttft': statistics.median(r['ttft'] for r in ok) if ok else None,
+            'tokens_per_sec': sum(r['tokens'] for r in ok) / generation_seconds if generation_seconds > 0 else 0.0,
+            'error_rate': (len(measured) - len(ok)) / len(measured) if measured else 1.0,
+            'measured': len(measured), 'rate_limited': len(results) - len(measured),
+            'errors': sorted({r['error'] for r in results if r['error']}),
+        })
+    return summaries
+
+def rank_benchmark_results(summaries, max_error_rate=DEFAULT_BENCHMARK_MAX_ERROR_RATE):
+    """Orders models: acceptable ones (error rate within limit) by median TTFT, then throughput; the rest last."""
+    def sort_key(s):
+        acceptable = s['ttft'] is not None and s['error_rate'] <= max_error_rate
+        return (not acceptable, s['ttft'] if s['ttft'] is not None else float('inf'), -s['tokens_per_sec'])
+    ranked = sorted(summaries, key=sort_key)
+    for s in ranked: s['acceptable'] = s['ttft'] is not None and s['error_rate'] <= max_error_rate
+    return ranked
+
+def print_benchmark_table(ranked):
+    """Prints the ranked benchmark results."""
+    width = max([len(s['model']) for s in ranked] + [5])
+    print(f"\n  #  {'Model':<{width}}  {'TTFT (median)':>13}  {'Tokens/s':>9}  {'Errors':>6}  {'Limited':>7}")
+    for i, s in enumerate(ranked, 1):
+        ttft = f"{s['ttft']:.2f}s" if s['ttft'] is not None else "-"
+        errors = f"{s['error_rate']:.0%}" if s['measured'] else "-"
+        note = "" if s['acceptable'] else "  (not acceptable)" if s['measured'] else "  (rate limited throughout; rerun later)"
+        print(f"  {i:>2} {s['model']:<{width}}  {ttft:>13}  {s['tokens_per_sec']:>9.1f}  {errors:>6}  {s['rate_limited']:>7}{note}")
+        if s['errors'] and not s['acceptable']: print(f"     {'':<{width}}  e.g. {s['errors'][0][:100]}")
+
 # --- Main Function ---
 def main():
     check_privileges()
@@ -99,6 +202,14 @@ def main():
                         help="Run non-interactively (requires --token and --apikey)")
     parser.add_argument('--force', '-f', action='store_true',
                         help="Force overwrite of existing .env file without prompting")
+    parser.add_argument('--benchmark-models', action='store_true',
+                        help="Measure time-to-first-token, tokens/sec and error rate of candidate models, then suggest the fastest")
+    parser.add_argument('--benchmark-candidates', metavar='MODELS',
+                        help="Comma-separated models to benchmark (default: stable gemini-* chat models)")
+    parser.add_argument('--benchmark-concurrency', type=int, default=DEFAULT_BENCHMARK_CONCURRENCY,
+                        help="Benchmark requests in flight at once")
+    parser.add_argument('--benchmark-max-error-rate', type=float, default=DEFAULT_BENCHMARK_MAX_ERROR_RATE,
+                        help="Highest share of failed benchmark prompts for a model to be acceptable")
     args = parser.parse_args()
 
     # Determine Mode & Get Values
@@ -153,8 +264,32 @@ def main():
         print("\nError: Could not retrieve usable models.\nConfiguration aborted.", file=sys.stderr); sys.exit(1)
     print("--> API Key verified.")
 
-    # Select/Validate Model
+    # Optional: Benchmark candidate models and offer the fastest acceptable one (plus fallbacks)
     final_model_name = ""
+    acceptable_models = []
+    if args.benchmark_models:
+        if args.benchmark_candidates:
+            candidates = [m.strip() for m in args.benchmark_candidates.split(',') if m.strip()]
+            unknown = [m for m in candidates if m not in available_models]
+            if unknown: print(f"Warning: Skipping unavailable model(s): {', '.join(unknown)}", file=sys.stderr)
+            candidates = [m for m in candidates if m in available_models]
+        else:
+            candidates = default_benchmark_candidates(available_models)
+        print(f"--> Benchmarking {len(candidates)} model(s) with {len(BENCHMARK_PROMPTS)} prompts each (concurrency {args.benchmark_concurrency})...")
+        ranked = rank_benchmark_results(benchmark_models(candidates, concurrency=args.benchmark_concurrency), args.benchmark_max_error_rate)
+        print_benchmark_table(ranked)
+        acceptable_models = [s['model'] for s in ranked if s['acceptable']]
+        if not acceptable_models:
+            print("Warning: No model passed the benchmark. Select a model manually.", file=sys.stderr)
+        elif args.non_interactive:
+            if not args.model: model_name_arg = acceptable_models[0] # An explicit --model still wins
+        else:
+            fallbacks = acceptable_models[1:1 + BENCHMARK_FALLBACK_COUNT]
+            print(f"\nFastest acceptable model: {acceptable_models[0]}" + (f" (fallbacks: {', '.join(fallbacks)})" if fallbacks else ""))
+            if input("Use it? (Y/n): ").strip().lower() in ('', 'y', 'yes'):
+                final_model_name = acceptable_models[0]
+
+    # Select/Validate Model
     # Non-interactive: Use provided or default, must be valid
     if args.non_interactive:
         if model_name_arg in available_models:
@@ -163,8 +298,8 @@ def main():
         else:
             print(f"Error: Specified/Default model '{model_name_arg}' unavailable or invalid.", file=sys.stderr)
             print(f"Available models: {', '.join(available_models)}", file=sys.stderr); sys.exit(1)
-    # Interactive: Let user choose from list
-    else:
+    # Interactive: Let user choose from list (unless the benchmark suggestion was accepted)
+    elif not final_model_name:
         print("\nAvailable Gemini Models:")
         for i, m_name in enumerate(available_models): print(f"  {i+1}) {m_name}")
 
@@ -196,6 +331,9 @@ def main():
             except ValueError:
                 print("Invalid input. Please enter a number.")
 
+    # Ordered fallback list: the next-fastest acceptable models from the benchmark
+    fallback_models = [m for m in acceptable_models if m != final_model_name][:BENCHMARK_FALLBACK_COUNT]
+
     # Final Confirmation (Interactive only)
     if not args.non_interactive:
         print("\n--- Configuration Summary ---")
@@ -204,6 +342,7 @@ def main():
         print(f"Author Discord ID:   {author_id or '<Not Set>'}")
         print(f"Timeout Seconds:     {timeout_secs}")
         print(f"Gemini Model:        {final_model_name}")
+        if fallback_models: print(f"Fallback Models:     {', '.join(fallback_models)}")
         print(f"Target File:         {ENV_FILE}")
         print(f"Owner/Permissions:   {SERVICE_USER}:{SERVICE_GROUP} / {oct(ENV_PERMS)[2:]}")
         confirm_write = input("\nProceed with writing this configuration? (y/N): ").strip().lower()
@@ -234,6 +373,9 @@ def main():
             f.write(f"GEMINI_API_KEY={gemini_api_key}\n\n")
             f.write("# Gemini Model to use (verified available)\n")
             f.write(f"GEMINI_MODEL_NAME={final_model_name}\n\n")
+            if fallback_models:
+                f.write("# Next-fastest models measured by --benchmark-models, in order (switch to one if the model above degrades)\n")
+                f.write(f"GEMINI_FALLBACK_MODELS={','.join(fallback_models)}\n\n")
             f.write("# Conversation history timeout in seconds\n")
             f.write(f"CONVERSATION_TIMEOUT_SECONDS={timeout_secs}\n\n")
             f.write("# Optional: Author's Discord User ID for '-dono' honorific\n")
@@ -18,6 +18,18 @@ import logging.handlers
 import signal
 import argparse
 import contextlib
+import contextvars
+import collections
+import shutil
+import glob
+import subprocess
+import io
+import tracemalloc
+import json
+import queue
+import random
+import time
+import hashlib
 
 # Third-Party Imports
 try: import google.generativeai as genai; from google.api_core import exceptions as google_api_exceptions; from google.generativeai import types as genai_types
@@ -28,6 +40,8 @@ try: import pidfile # Imports the main module
 except ImportError: print("Error: 'python-pidfile' not found. Install: `pip install python-pidfile>=3.0.0`", file=sys.stderr); sys.exit(1)
 try: import psutil
 except ImportError: print("Error: 'psutil' not found. Install: `pip install psutil`", file=sys.stderr); sys.exit(1)
+try: import uvloop # Optional: faster event loop engine (--loop uvloop)
+except ImportError: uvloop = None
 
 # --- Constants ---
 APP_NAME = "yui-bot"
@@ -36,8 +50,42 @@ DEFAULT_RUN_DIR = f"/var/run/{APP_NAME}" # Should match systemd RuntimeDirectory
 PID_FILENAME = f"{APP_NAME}.pid"
 DEFAULT_PID_PATH = os.path.join(DEFAULT_RUN_DIR, PID_FILENAME)
 DEFAULT_ENV_FILE = os.path.join(DEFAULT_CONFIG_DIR, ".env")
+DEFAULT_STATE_DIR = f"/var/lib/{APP_NAME}" # Should match systemd StateDirectory
+DEFAULT_MAN_STATS_FILE = os.path.join(DEFAULT_STATE_DIR, "man-popular.json")
 
 MAX_MESSAGE_LENGTH = 1990
+EVENT_LOOP_CHOICES = ('asyncio', 'uvloop')
+GENERATION_PROFILES = ('general', 'man', 'summarize') # One GenerativeModel (generation config + system instruction) each
+MAN_SYSTEM_INSTRUCTION = ("You generate the content of standard Linux/Unix man pages. The user message names the page, "
+                          "optionally with a section (e.g. 'ls', '5 passwd' or 'printf(3)'). Use typical man page structure "
+                          "(NAME, SYNOPSIS, DESCRIPTION, OPTIONS, EXAMPLES, etc.) and plain text without Markdown. "
+                          "If no standard man page exists or you cannot provide it, respond *only* with the exact text "
+                          "'man: no manual entry for ' followed by the user message exactly as given.")
+SUMMARIZE_SYSTEM_INSTRUCTION = ("Summarize the text you are given for a Discord channel: a few short bullet points "
+                                "covering the main points, decisions and open questions. Do not add information that is not in the text.")
+DEFAULT_GENERATION_PROFILES = {
+    'general': {'max_output_tokens': 2048, 'temperature': None, 'stop_sequences': [], 'system_instruction': ""},
+    'man': {'max_output_tokens': 4096, 'temperature': 0.2, 'stop_sequences': [], 'system_instruction': MAN_SYSTEM_INSTRUCTION},
+    'summarize': {'max_output_tokens': 512, 'temperature': 0.3, 'stop_sequences': [], 'system_instruction': SUMMARIZE_SYSTEM_INSTRUCTION},
+}
+GEMINI_TRANSPORT_CHOICES = ('grpc_asyncio', 'grpc', 'rest') # genai.configure(transport=...); the bot's calls are all async
+GEMINI_COLD_IDLE_SECONDS = 300 # A Gemini request after this much silence is counted as a cold (new connection) request
+DEFAULT_TRACE_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_TRACE_BACKUP_COUNT = 3
+DEFAULT_CAPTURE_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_CAPTURE_BACKUP_COUNT = 5
+TRACE_QUEUE_SIZE = 10000 # Spans buffered for the exporter thread before new ones are dropped
+DEFAULT_CHAT_SESSION_CACHE_SIZE = 256
+DEFAULT_CHAT_SESSION_CACHE_MAX_BYTES = 8 * 1024 * 1024
+DEFAULT_MANPATH = "/usr/local/share/man:/usr/share/man"
+MAN_SECTION_ORDER = ('1', 'n', 'l', '8', '3', '0', '2', '5', '4', '9', '6', '7') # man-db default search order
+MAN_PAGE_SUFFIXES = ('.gz', '.xz', '.bz2', '.zst', '.lzma', '')
+MAN_SECTION_SUFFIX_PATTERN = re.compile(r'^[a-z0-9]*(?:\.(?:gz|xz|bz2|zst|lzma))?$') # What may follow "<name>.<sec>" (e.g. "ossl.gz", "pm")
+MAN_HISTORY_EXCERPT_CHARS = 1500 # Start of a locally rendered/cached man page kept in conversation history
+MAN_QUERY_PATTERN = re.compile(r'^(?:(?P<section>[0-9][a-z0-9]*|[nl])\s+)?(?P<name>[A-Za-z0-9_][\w.:+@-]*)(?:\((?P<paren_section>[0-9][a-z0-9]*|[nl])\))?$')
+MAN_FORMATTING_PATTERN = re.compile(r'.\x08|\x1b\[[0-9;]*m') # Overstrike bold/underline and SGR escapes
+MAN_STATS_MAX_PAGES = 500 # Request counts kept in the persisted popularity file
+TRACEMALLOC_IGNORED_FILES = ('<frozen importlib._bootstrap>', '<frozen importlib._bootstrap_external>', '<unknown>', tracemalloc.__file__)
 BOTSNACK_VIDEO_URL = "https://www.youtube.com/watch?v=vGcHnP4_i3g" # C is for Lettuce URL
 
 # --- Logger Setup ---
@@ -76,33 +124,263 @@ def setup_logging(log_level_str='INFO', log_to_console=False):
         logger.addHandler(console_handler)
         logger.debug("Console logging enabled.")
 
-# --- Configuration Loading ---
-def load_configuration(env_file_path):
-    """Loads configuration from .env file, validates, returns config dict."""
-    logger.info(f"Loading configuration from: {env_file_path}")
-    if not os.path.isfile(env_file_path):
-        logger.critical(f"Configuration file not found or is not a file: {env_file_path}")
-        sys.exit(1)
-    if not os.access(env_file_path, os.R_OK):
-         logger.critical(f"Configuration file not readable: {env_file_path}. Check permissions.")
-         sys.exit(1) # Exit here if not readable
+# --- Tracing (OTLP-shaped JSONL export) ---
+current_span = contextvars.ContextVar('current_span', default=None)
+
+class NoopSpan:
+    """Stand-in returned when tracing is disabled or the trace was not sampled."""
+    sampled = False
+    def set_attribute(self, key, value): pass
+    def set_error(self, exc): pass
+    def end(self, end_ns=None): pass
+
+NOOP_SPAN = NoopSpan()
+
+class Span:
+    """A single timed operation. Child spans inherit the parent's attributes at creation."""
+    sampled = True
+    __slots__ = ('tracer', 'trace_id', 'span_id', 'parent_span_id', 'name', 'attributes', 'start_ns', 'end_ns', 'error')
+
+    def __init__(self, tracer, name, parent, attributes, start_ns=None):
+        self.tracer = tracer; self.name = name; self.error = None; self.end_ns = None
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.parent_span_id = parent.span_id if parent else ""
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.attributes = dict(parent.attributes) if parent else {}
+        self.attributes.update(attributes)
+        self.start_ns = start_ns if start_ns is not None else time.time_ns()
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def set_error(self, exc):
+        self.error = f"{type(exc).__name__}: {exc}"
+
+    def end(self, end_ns=None):
+        if self.end_ns is not None: return # Already exported
+        self.end_ns = end_ns if end_ns is not None else time.time_ns()
+        self.tracer.export(self)
+
+def otlp_attribute_value(value):
+    """Encodes a Python value as an OTLP/JSON AnyValue."""
+    if isinstance(value, bool): return {'boolValue': value}
+    if isinstance(value, int): return {'intValue': str(value)} # OTLP/JSON encodes int64 as string
+    if isinstance(value, float): return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+class OtlpJsonFormatter(logging.Formatter):
+    """Serializes the span attached to a log record as one OTLP/JSON ExportTraceServiceRequest line."""
+    def format(self, record):
+        span = record.span
+        otlp_span = {
+            'traceId': span.trace_id, 'spanId': span.span_id, 'parentSpanId': span.parent_span_id,
+            'name': span.name, 'kind': 1, # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(span.start_ns), 'endTimeUnixNano': str(span.end_ns),
+            'attributes': [{'key': k, 'value': otlp_attribute_value(v)} for k, v in span.attributes.items()],
+            'status': {'code': 2, 'message': span.error} if span.error else {'code': 1}, # ERROR / OK
+        }
+        return json.dumps({'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': APP_NAME}}]},
+            'scopeSpans': [{'scope': {'name': APP_NAME}, 'spans': [otlp_span]}],
+        }]}, separators=(',', ':'))
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler that drops records instead of blocking (or erroring) when the queue is full."""
+    dropped = 0
+    def prepare(self, record):
+        return record # Serialization happens in the listener thread (OtlpJsonFormatter)
+    def enqueue(self, record):
+        try: self.queue.put_nowait(record)
+        except queue.Full: self.dropped += 1
+
+class JsonlWriter:
+    """Writes records as JSON lines to a rotating file from a background thread, dropping them if the thread falls behind."""
+    def __init__(self, formatter, item_name):
+        self.formatter = formatter; self.item_name = item_name # e.g. "span" (for log messages)
+        self.queue_handler = None; self.listener = None
+
+    @property
+    def dropped(self):
+        return self.queue_handler.dropped if self.queue_handler else 0
+
+    def start(self, path, max_bytes, backup_count):
+        """Opens the file and starts the writer thread. Raises OSError if the file cannot be opened."""
+        file_handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        file_handler.setFormatter(self.formatter)
+        self.queue_handler = DroppingQueueHandler(queue.Queue(maxsize=TRACE_QUEUE_SIZE))
+        self.listener = logging.handlers.QueueListener(self.queue_handler.queue, file_handler)
+        self.listener.start()
+
+    def stop(self):
+        """Flushes queued records and stops the writer thread."""
+        if self.listener:
+            self.listener.stop()
+            for handler in self.listener.handlers: handler.close()
+            if self.dropped: logger.warning(f"Dropped {self.dropped} {self.item_name}(s): the {self.item_name} writer queue was full.")
+            self.listener = None
+
+    def write(self, name, **payload):
+        """Queues one record; the payload becomes attributes of the log record (read by the formatter)."""
+        if self.queue_handler:
+            record = logging.LogRecord(APP_NAME, logging.INFO, __file__, 0, name, None, None)
+            record.__dict__.update(payload)
+            self.queue_handler.handle(record)
+
+class Tracer:
+    """Records per-interaction spans and exports them to a rotating JSONL file from a background thread."""
+    def __init__(self):
+        self.enabled = False; self.sample_rate = 0.0
+        self.writer = JsonlWriter(OtlpJsonFormatter(), "trace span")
+
+    def configure(self, path, sample_rate=1.0, max_bytes=DEFAULT_TRACE_MAX_BYTES, backup_count=DEFAULT_TRACE_BACKUP_COUNT):
+        """Starts the exporter thread. Tracing stays disabled if the file cannot be opened."""
+        try:
+            self.writer.start(path, max_bytes, backup_count)
+        except OSError as e:
+            logger.warning(f"Could not open trace file {path}: {e}. Tracing disabled.")
+            return False
+        self.sample_rate = sample_rate; self.enabled = True
+        logger.info(f"Tracing enabled: {path} (sample rate {sample_rate}, rotate at {max_bytes}b x{backup_count})")
+        return True
+
+    def shutdown(self):
+        """Flushes queued spans and stops the exporter thread."""
+        self.enabled = False
+        self.writer.stop()
+
+    def start_span(self, name, start_ns=None, **attributes):
+        """Starts a span under the current span without making it current. Caller must call end()."""
+        parent = current_span.get()
+        if not self.enabled or parent is NOOP_SPAN: return NOOP_SPAN
+        if parent is None and random.random() >= self.sample_rate: return NOOP_SPAN
+        return Span(self, name, parent, attributes, start_ns)
+
+    def record_span(self, name, start_ns, end_ns, **attributes):
+        """Records an already-finished span (e.g. time to first chunk) under the current span."""
+        span = self.start_span(name, start_ns=start_ns, **attributes)
+        span.end(end_ns)
+
+    @contextlib.contextmanager
+    def span(self, name, start_ns=None, **attributes):
+        """Context manager that times a block and makes the span current for nested spans."""
+        span = self.start_span(name, start_ns=start_ns, **attributes)
+        if span is NOOP_SPAN and current_span.get() is not None:
+            yield span; return # Not sampled/disabled and already inside a trace; nothing to track
+        token = current_span.set(span) # NOOP_SPAN marks the whole trace as unsampled
+        try:
+            yield span
+        except BaseException as e: # Includes cancellation
+            span.set_error(e)
+            raise
+        finally:
+            current_span.reset(token)
+            span.end()
+
+    def export(self, span):
+        self.writer.write(span.name, span=span)
+
+tracer = Tracer()
+
+# --- Traffic Capture (anonymized event metadata for --replay) ---
+class CaptureJsonFormatter(logging.Formatter):
+    """Serializes the capture event attached to a log record as one compact JSON line."""
+    def format(self, record):
+        return json.dumps(record.event, separators=(',', ':'))
+
+class TrafficCapture:
+    """Records anonymized traffic metadata (hashed IDs, sizes, timings; never content) to a JSONL file from a background thread."""
+    def __init__(self):
+        self.enabled = False; self.writer = JsonlWriter(CaptureJsonFormatter(), "capture event")
+        self.hash_key = os.urandom(16) # Per process: links events within a capture, but not back to Discord IDs
+
+    def configure(self, path, max_bytes=DEFAULT_CAPTURE_MAX_BYTES, backup_count=DEFAULT_CAPTURE_BACKUP_COUNT):
+        """Starts the writer thread. Capture stays disabled if the file cannot be opened."""
+        try:
+            self.writer.start(path, max_bytes, backup_count)
+        except OSError as e:
+            logger.warning(f"Could not open capture file {path}: {e}. Capture disabled.")
+            return False
+        self.enabled = True
+        logger.info(f"Traffic capture enabled: {path} (rotate at {max_bytes}b x{backup_count})")
+        return True
+
+    def shutdown(self):
+        """Flushes queued events and stops the writer thread."""
+        self.enabled = False
+        self.writer.stop()
+
+    def anonymize(self, discord_id):
+        return hashlib.blake2b(str(discord_id).encode(), key=self.hash_key, digest_size=6).hexdigest()
+
+    def record(self, event, **fields):
+        """Queues one event: 't' (unix time), 'e' (event type) plus the given fields (None values omitted)."""
+        if not self.enabled: return
+        self.writer.write(event, event={'t': round(time.time(), 3), 'e': event, **{k: v for k, v in fields.items() if v is not None}})
 
+capture = TrafficCapture()
+
+# --- Configuration Loading ---
+def getenv_bool(name, default):
+    """Reads a true/false setting from the environment, warning and using the default if unrecognized."""
+    raw_value = os.getenv(name)
+    if raw_value is None or not raw_value.strip(): return default
+    value = raw_value.strip().lower()
+    if value in ('1', 'true', 'yes', 'on'): return True
+    if value in ('0', 'false', 'no', 'off'): return False
+    logger.warning(f"Invalid {name} ('{raw_value}'). Defaulting to {default}.")
+    return default
+
+def getenv_number(name, default, cast=int, minimum=None, maximum=None):
+    """Reads a numeric setting from the environment, warning and using the default if invalid or out of range."""
+    raw_value = os.getenv(name)
+    if raw_value is None or not raw_value.strip(): return default
     try:
-        load_dotenv(dotenv_path=env_file_path, override=True) # Override existing env vars if set in file
-    except Exception as e:
-        logger.critical(f"Error loading .env file ({env_file_path}): {e}", exc_info=True)
-        sys.exit(1)
+        value = cast(raw_value.strip())
+        if (minimum is not None and value < minimum) or (maximum is not None and value > maximum):
+            raise ValueError("out of range")
+        return value
+    except (ValueError, TypeError):
+        logger.warning(f"Invalid {name} ('{raw_value}'). Defaulting to {default}.")
+        return default
+
+def load_configuration(env_file_path, require_credentials=True):
+    """Loads configuration from .env file, validates, returns config dict.
+
+    With env_file_path None only the environment and defaults are used. require_credentials=False
+    skips the token/API key checks (offline tools such as --replay only need the tuning keys).
+    """
+    if env_file_path is None:
+        logger.info("No configuration file given; using the environment and defaults.")
+    else:
+        logger.info(f"Loading configuration from: {env_file_path}")
+        if not os.path.isfile(env_file_path):
+            logger.critical(f"Configuration file not found or is not a file: {env_file_path}")
+            sys.exit(1)
+        if not os.access(env_file_path, os.R_OK):
+             logger.critical(f"Configuration file not readable: {env_file_path}. Check permissions.")
+             sys.exit(1) # Exit here if not readable
+
+        try:
+            load_dotenv(dotenv_path=env_file_path, override=True) # Override existing env vars if set in file
+        except Exception as e:
+            logger.critical(f"Error loading .env file ({env_file_path}): {e}", exc_info=True)
+            sys.exit(1)
 
     config = {}
     config['DISCORD_BOT_TOKEN'] = os.getenv("DISCORD_BOT_TOKEN")
     config['GEMINI_API_KEY'] = os.getenv("GEMINI_API_KEY")
     config['GEMINI_MODEL_NAME'] = os.getenv("GEMINI_MODEL_NAME", "gemini-1.5-flash")
+    # Written by configure-yui-bot.py --benchmark-models. Informational: the bot never switches models by itself
+    config['GEMINI_FALLBACK_MODELS'] = [m.strip() for m in os.getenv("GEMINI_FALLBACK_MODELS", "").split(',') if m.strip()]
+    if config['GEMINI_FALLBACK_MODELS']:
+        logger.info(f"Benchmarked fallback models (switch GEMINI_MODEL_NAME manually if needed): {', '.join(config['GEMINI_FALLBACK_MODELS'])}")
     config['AUTHOR_DISCORD_ID'] = os.getenv("AUTHOR_DISCORD_ID")
     config['ENV_FILE_PATH'] = env_file_path # Store path for reference
 
     # Validate required variables
-    if not config['DISCORD_BOT_TOKEN']: logger.critical("DISCORD_BOT_TOKEN missing."); sys.exit(1)
-    if not config['GEMINI_API_KEY']: logger.critical("GEMINI_API_KEY missing."); sys.exit(1)
+    if require_credentials:
+        if not config['DISCORD_BOT_TOKEN']: logger.critical("DISCORD_BOT_TOKEN missing."); sys.exit(1)
+        if not config['GEMINI_API_KEY']: logger.critical("GEMINI_API_KEY missing."); sys.exit(1)
     if not config['AUTHOR_DISCORD_ID']: logger.warning("AUTHOR_DISCORD_ID missing. -dono disabled.")
     else: logger.info(f"Author Discord ID loaded: {config['AUTHOR_DISCORD_ID']}")
 
@@ -118,14 +396,268 @@ def load_configuration(env_file_path):
     config['CONVERSATION_TIMEOUT_DELTA'] = timedelta(seconds=config['CONVERSATION_TIMEOUT_SECONDS'])
     logger.info(f"Conversation timeout: {config['CONVERSATION_TIMEOUT_SECONDS']}s.")
 
+    # Event Loop Engine (overridden by --loop)
+    config['EVENT_LOOP'] = os.getenv("EVENT_LOOP", "asyncio").strip().lower()
+    if config['EVENT_LOOP'] not in EVENT_LOOP_CHOICES:
+        logger.warning(f"Invalid EVENT_LOOP ('{config['EVENT_LOOP']}'). Expected one of {', '.join(EVENT_LOOP_CHOICES)}. Defaulting to asyncio.")
+        config['EVENT_LOOP'] = 'asyncio'
+
+    # Interaction Tracing (disabled unless TRACE_FILE is set)
+    config['TRACE_FILE'] = os.getenv("TRACE_FILE", "").strip()
+    config['TRACE_SAMPLE_RATE'] = getenv_number("TRACE_SAMPLE_RATE", 1.0, cast=float, minimum=0.0, maximum=1.0)
+    config['TRACE_MAX_BYTES'] = getenv_number("TRACE_MAX_BYTES", DEFAULT_TRACE_MAX_BYTES, minimum=1024)
+    config['TRACE_BACKUP_COUNT'] = getenv_number("TRACE_BACKUP_COUNT", DEFAULT_TRACE_BACKUP_COUNT, minimum=0)
+
+    # Live Gemini ChatSession reuse (0 entries disables)
+    config['CHAT_SESSION_CACHE_SIZE'] = getenv_number("CHAT_SESSION_CACHE_SIZE", DEFAULT_CHAT_SESSION_CACHE_SIZE, minimum=0)
+    config['CHAT_SESSION_CACHE_MAX_BYTES'] = getenv_number("CHAT_SESSION_CACHE_MAX_BYTES", DEFAULT_CHAT_SESSION_CACHE_MAX_BYTES, minimum=0)
+    logger.info(f"Chat session cache: {config['CHAT_SESSION_CACHE_SIZE']} sessions / {config['CHAT_SESSION_CACHE_MAX_BYTES']}b.")
+
+    # Local man pages (rendered from the host's manpath before falling back to Gemini)
+    config['MAN_LOCAL_PAGES'] = getenv_bool("MAN_LOCAL_PAGES", True)
+    config['MAN_PAGE_PATH'] = os.getenv("MAN_PAGE_PATH", "").strip() # Empty: ask `manpath`
+    config['MAN_RENDER_CONCURRENCY'] = getenv_number("MAN_RENDER_CONCURRENCY", 2, minimum=1)
+    config['MAN_RENDER_TIMEOUT_SECONDS'] = getenv_number("MAN_RENDER_TIMEOUT_SECONDS", 10.0, cast=float, minimum=0.1)
+    config['MAN_RENDER_WIDTH'] = getenv_number("MAN_RENDER_WIDTH", 80, minimum=40, maximum=200)
+    config['MAN_CACHE_SIZE'] = getenv_number("MAN_CACHE_SIZE", 128, minimum=0)
+    config['MAN_CACHE_MAX_BYTES'] = getenv_number("MAN_CACHE_MAX_BYTES", 8 * 1024 * 1024, minimum=0)
+
+    # Man page cache prewarming (configured list + learned most requested pages)
+    config['MAN_PREWARM'] = getenv_bool("MAN_PREWARM", True)
+    config['MAN_PREWARM_PAGES'] = [p.strip() for p in os.getenv("MAN_PREWARM_PAGES", "").split(',') if p.strip()]
+    config['MAN_PREWARM_TOP_N'] = getenv_number("MAN_PREWARM_TOP_N", 20, minimum=0)
+    config['MAN_PREWARM_CONCURRENCY'] = getenv_number("MAN_PREWARM_CONCURRENCY", 1, minimum=1)
+    config['MAN_PREWARM_GEMINI_INTERVAL_SECONDS'] = getenv_number("MAN_PREWARM_GEMINI_INTERVAL_SECONDS", 5.0, cast=float, minimum=0.0)
+    config['MAN_STATS_FILE'] = os.getenv("MAN_STATS_FILE", DEFAULT_MAN_STATS_FILE).strip()
+    config['MAN_STATS_SAVE_INTERVAL_SECONDS'] = getenv_number("MAN_STATS_SAVE_INTERVAL_SECONDS", 600, minimum=10)
+
+    # Diagnostics dump (SIGUSR1) and runtime-switchable tracemalloc (SIGUSR2)
+    config['DIAGNOSTICS_DIR'] = os.getenv("DIAGNOSTICS_DIR", "").strip() # Empty: directory of the PID file
+    config['DIAGNOSTICS_TOP_N'] = getenv_number("DIAGNOSTICS_TOP_N", 25, minimum=1)
+    config['TRACEMALLOC_AT_STARTUP'] = getenv_bool("TRACEMALLOC_AT_STARTUP", False)
+    config['TRACEMALLOC_FRAMES'] = getenv_number("TRACEMALLOC_FRAMES", 5, minimum=1, maximum=100)
+
+    # Debounce: merge rapid-fire general prompts from the same user/channel (opt-in: the window delays every general prompt)
+    config['DEBOUNCE_SECONDS'] = getenv_number("DEBOUNCE_SECONDS", 0.0, cast=float, minimum=0.0)
+    config['DEBOUNCE_MAX_SECONDS'] = getenv_number("DEBOUNCE_MAX_SECONDS", 4.0, cast=float, minimum=0.0)
+    config['DEBOUNCE_MAX_MESSAGES'] = getenv_number("DEBOUNCE_MAX_MESSAGES", 5, minimum=1)
+    if config['DEBOUNCE_SECONDS'] > 0:
+        logger.info(f"Debounce window: {config['DEBOUNCE_SECONDS']}s (max {config['DEBOUNCE_MAX_SECONDS']}s, {config['DEBOUNCE_MAX_MESSAGES']} messages).")
+    # Long replies: one attachment instead of many rate-limited messages (0 disables)
+    config['ATTACHMENT_THRESHOLD_CHARS'] = getenv_number("ATTACHMENT_THRESHOLD_CHARS", 6000, minimum=0)
+    config['ATTACHMENT_PREVIEW_CHARS'] = getenv_number("ATTACHMENT_PREVIEW_CHARS", 400, minimum=0, maximum=MAX_MESSAGE_LENGTH - 200)
+    if config['ATTACHMENT_THRESHOLD_CHARS']:
+        logger.info(f"Replies over {config['ATTACHMENT_THRESHOLD_CHARS']} characters are sent as a file ({config['ATTACHMENT_PREVIEW_CHARS']} character preview).")
+
+    # Generation profiles per command: PROFILE_<NAME>_{MAX_OUTPUT_TOKENS,TEMPERATURE,STOP_SEQUENCES,SYSTEM_INSTRUCTION}
+    config['GENERATION_PROFILES'] = {}
+    for profile, defaults in DEFAULT_GENERATION_PROFILES.items():
+        prefix = f"PROFILE_{profile.upper()}_"
+        stop_sequences = os.getenv(f"{prefix}STOP_SEQUENCES")
+        system_instruction = os.getenv(f"{prefix}SYSTEM_INSTRUCTION")
+        config['GENERATION_PROFILES'][profile] = {
+            'max_output_tokens': getenv_number(f"{prefix}MAX_OUTPUT_TOKENS", defaults['max_output_tokens'], minimum=0), # 0 = model limit
+            'temperature': getenv_number(f"{prefix}TEMPERATURE", defaults['temperature'], cast=float, minimum=0.0, maximum=2.0), # None = model default
+            'stop_sequences': [s.strip() for s in stop_sequences.split(',') if s.strip()][:5] if stop_sequences is not None else defaults['stop_sequences'],
+            'system_instruction': system_instruction.strip() if system_instruction is not None else defaults['system_instruction'],
+        }
+        logger.info(f"Generation profile '{profile}': max_output_tokens={config['GENERATION_PROFILES'][profile]['max_output_tokens'] or 'model limit'}, "
+                    f"temperature={config['GENERATION_PROFILES'][profile]['temperature']}, stop_sequences={config['GENERATION_PROFILES'][profile]['stop_sequences']}.")
+
+    # Exact-match response cache for general prompts without history (opt-in)
+    config['RESPONSE_CACHE'] = getenv_bool("RESPONSE_CACHE", False)
+    config['RESPONSE_CACHE_SIZE'] = getenv_number("RESPONSE_CACHE_SIZE", 256, minimum=1)
+    config['RESPONSE_CACHE_MAX_BYTES'] = getenv_number("RESPONSE_CACHE_MAX_BYTES", 4 * 1024 * 1024, minimum=0)
+    config['RESPONSE_CACHE_TTL_SECONDS'] = getenv_number("RESPONSE_CACHE_TTL_SECONDS", 3600, minimum=1)
+    if config['RESPONSE_CACHE']:
+        logger.info(f"Response cache: {config['RESPONSE_CACHE_SIZE']} answers / {config['RESPONSE_CACHE_MAX_BYTES']}b, TTL {config['RESPONSE_CACHE_TTL_SECONDS']}s.")
+
+    # Per-(channel, user) lanes: interactions on one conversation run in order
+    config['LANE_MAX_QUEUED'] = getenv_number("LANE_MAX_QUEUED", 3, minimum=0)
+    logger.info(f"Conversation lanes: up to {config['LANE_MAX_QUEUED']} queued request(s) per user and channel.")
+
+    # Opt-in traffic capture (anonymized metadata only) for --replay
+    config['CAPTURE_FILE'] = os.getenv("CAPTURE_FILE", "").strip()
+    config['CAPTURE_MAX_BYTES'] = getenv_number("CAPTURE_MAX_BYTES", DEFAULT_CAPTURE_MAX_BYTES, minimum=1024)
+    config['CAPTURE_BACKUP_COUNT'] = getenv_number("CAPTURE_BACKUP_COUNT", DEFAULT_CAPTURE_BACKUP_COUNT, minimum=0)
+
+    # Gemini transport and connection warm-up/keepalive
+    config['GEMINI_TRANSPORT'] = os.getenv("GEMINI_TRANSPORT", "grpc_asyncio").strip().lower()
+    if config['GEMINI_TRANSPORT'] not in GEMINI_TRANSPORT_CHOICES:
+        logger.warning(f"Invalid GEMINI_TRANSPORT ('{config['GEMINI_TRANSPORT']}'). Expected one of {', '.join(GEMINI_TRANSPORT_CHOICES)}. Defaulting to grpc_asyncio.")
+        config['GEMINI_TRANSPORT'] = 'grpc_asyncio'
+    elif config['GEMINI_TRANSPORT'] != 'grpc_asyncio':
+        logger.warning(f"GEMINI_TRANSPORT={config['GEMINI_TRANSPORT']} is synchronous; Gemini calls may stall the event loop. Use it only to troubleshoot (e.g. proxies without HTTP/2).")
+    config['GEMINI_WARMUP'] = getenv_bool("GEMINI_WARMUP", True)
+    config['GEMINI_KEEPALIVE_SECONDS'] = getenv_number("GEMINI_KEEPALIVE_SECONDS", 120.0, cast=float, minimum=0.0) # 0 disables
+    logger.info(f"Gemini transport: {config['GEMINI_TRANSPORT']} (warm-up {'on' if config['GEMINI_WARMUP'] else 'off'}, keepalive every {config['GEMINI_KEEPALIVE_SECONDS']}s idle).")
+
+    # Gemini circuit breaker: fail fast while the API is erroring or too slow
+    config['GEMINI_BREAKER'] = getenv_bool("GEMINI_BREAKER", True)
+    config['GEMINI_BREAKER_WINDOW'] = getenv_number("GEMINI_BREAKER_WINDOW", 20, minimum=1)
+    config['GEMINI_BREAKER_MIN_CALLS'] = getenv_number("GEMINI_BREAKER_MIN_CALLS", 5, minimum=1)
+    config['GEMINI_BREAKER_FAILURE_RATE'] = getenv_number("GEMINI_BREAKER_FAILURE_RATE", 0.5, cast=float, minimum=0.01, maximum=1.0)
+    config['GEMINI_BREAKER_SLOW_SECONDS'] = getenv_number("GEMINI_BREAKER_SLOW_SECONDS", 20.0, cast=float, minimum=0.1)
+    config['GEMINI_BREAKER_OPEN_SECONDS'] = getenv_number("GEMINI_BREAKER_OPEN_SECONDS", 30.0, cast=float, minimum=1.0)
+    config['GEMINI_BREAKER_PROBE_INTERVAL_SECONDS'] = getenv_number("GEMINI_BREAKER_PROBE_INTERVAL_SECONDS", 10.0, cast=float, minimum=0.0)
+    config['GEMINI_BREAKER_PROBE_MAX_AGE_SECONDS'] = getenv_number("GEMINI_BREAKER_PROBE_MAX_AGE_SECONDS", 120.0, cast=float, minimum=1.0)
+    if config['GEMINI_BREAKER']:
+        logger.info(f"Gemini circuit breaker: opens at {config['GEMINI_BREAKER_FAILURE_RATE']:.0%} failed/slow (>{config['GEMINI_BREAKER_SLOW_SECONDS']}s) "
+                    f"of the last {config['GEMINI_BREAKER_WINDOW']} calls, for {config['GEMINI_BREAKER_OPEN_SECONDS']}s.")
+
     logger.info("Configuration loaded.")
     return config
 
+# --- LRU Cache ---
+class LRUCache:
+    """Least-recently-used cache bounded by entry count and total (estimated) bytes, with optional TTL."""
+    def __init__(self, name, max_entries, max_bytes=0, ttl_seconds=0):
+        self.name = name; self.max_entries = max_entries; self.max_bytes = max_bytes; self.ttl_seconds = ttl_seconds
+        self.entries = collections.OrderedDict() # key -> (value, size, stored_at); oldest first
+        self.total_bytes = 0; self.hits = 0; self.misses = 0; self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        """Returns the cached value (marking it most recently used) or default."""
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1; return default
+        if self.ttl_seconds and time.monotonic() - entry[2] > self.ttl_seconds:
+            self.pop(key); self.misses += 1; return default
+        self.entries.move_to_end(key); self.hits += 1
+        return entry[0]
+
+    def put(self, key, value, size=0):
+        """Stores a value, then evicts least recently used entries until within limits."""
+        if self.max_entries <= 0: return
+        if self.max_bytes and size > self.max_bytes: # Never fits; don't flush everything else for it
+            self.pop(key); return
+        self.pop(key)
+        self.entries[key] = (value, size, time.monotonic()); self.total_bytes += size
+        while len(self.entries) > self.max_entries or (self.max_bytes and self.total_bytes > self.max_bytes):
+            self.pop(next(iter(self.entries))); self.evictions += 1
+
+    def pop(self, key, default=None):
+        entry = self.entries.pop(key, None)
+        if entry is None: return default
+        self.total_bytes -= entry[1]
+        return entry[0]
+
+    def clear(self):
+        self.entries.clear(); self.total_bytes = 0
+
+    def oldest(self):
+        """Returns (key, value) of the least recently used entry, or None if empty."""
+        for key, entry in self.entries.items(): return key, entry[0]
+        return None
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'entries': len(self.entries), 'bytes': self.total_bytes, 'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions, 'hit_rate': round(self.hits / lookups, 3) if lookups else 0.0}
+
+# --- Circuit Breaker ---
+class CircuitBreaker:
+    """Closed/open/half-open breaker over a sliding window of call outcomes (errors and slow calls both fail)."""
+    CLOSED = 'closed'; OPEN = 'open'; HALF_OPEN = 'half_open'
+
+    def __init__(self, name, window=20, min_calls=5, failure_rate=0.5, open_seconds=30.0, probe_interval_seconds=10.0, probe_max_age_seconds=120.0, on_change=None):
+        self.name = name; self.enabled = True; self.on_change = on_change # on_change(old_state, new_state)
+        self.configure(window, min_calls, failure_rate, open_seconds, probe_interval_seconds, probe_max_age_seconds)
+        self.state = self.CLOSED; self.outcomes = collections.deque(maxlen=window) # True = failed
+        self.opened_at = 0.0; self.last_probe_at = 0.0; self.probe_in_flight = False
+        self.rejected = 0; self.stale_probes = 0; self.transitions = collections.Counter()
+
+    def configure(self, window, min_calls, failure_rate, open_seconds, probe_interval_seconds, probe_max_age_seconds=120.0):
+        self.window = window; self.min_calls = min_calls; self.failure_rate = failure_rate
+        self.open_seconds = open_seconds; self.probe_interval_seconds = probe_interval_seconds; self.probe_max_age_seconds = probe_max_age_seconds
+        if hasattr(self, 'outcomes'): self.outcomes = collections.deque(self.outcomes, maxlen=window)
+
+    def failure_ratio(self):
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def allow(self):
+        """Returns True if a call may go ahead. Half-open lets through one probe at a time, spaced out."""
+        if not self.enabled: return True
+        now = time.monotonic()
+        if self.state == self.OPEN:
+            if now - self.opened_at < self.open_seconds:
+                self.rejected += 1; return False
+            self._transition(self.HALF_OPEN)
+        if self.state == self.HALF_OPEN:
+            if self.probe_in_flight and now - self.last_probe_at >= self.probe_max_age_seconds: # Lost probe; don't stay half-open forever
+                logger.warning(f"Circuit breaker '{self.name}': probe unanswered after {self.probe_max_age_seconds}s. Allowing a new one.")
+                self.probe_in_flight = False; self.stale_probes += 1
+            if self.probe_in_flight or now - self.last_probe_at < self.probe_interval_seconds:
+                self.rejected += 1; return False
+            self.probe_in_flight = True; self.last_probe_at = now
+        return True
+
+    def record(self, failed, probe=False):
+        """Records a finished call. A probe's outcome closes or re-opens the breaker."""
+        if not self.enabled: return
+        if probe:
+            self.probe_in_flight = False
+            if self.state == self.HALF_OPEN: self._transition(self.OPEN if failed else self.CLOSED)
+            return
+        self.outcomes.append(bool(failed))
+        if self.state == self.CLOSED and len(self.outcomes) >= self.min_calls and self.failure_ratio() >= self.failure_rate:
+            self._transition(self.OPEN)
+
+    def release(self, probe=False):
+        """Forgets a call that ended without an outcome (e.g. cancelled), freeing the probe slot."""
+        if probe: self.probe_in_flight = False
+
+    def retry_at(self):
+        """Wall-clock time (UTC) after which the next probe is allowed while open."""
+        return datetime.datetime.now(datetime.timezone.utc) + timedelta(seconds=max(0.0, self.opened_at + self.open_seconds - time.monotonic()))
+
+    def _transition(self, new_state):
+        old_state = self.state; self.state = new_state; self.transitions[new_state] += 1
+        if new_state == self.OPEN: self.opened_at = time.monotonic()
+        elif new_state == self.HALF_OPEN: self.last_probe_at = 0.0; self.probe_in_flight = False
+        elif new_state == self.CLOSED: self.outcomes.clear()
+        if self.on_change: self.on_change(old_state, new_state)
+
+    def stats(self):
+        return {'state': self.state, 'calls': len(self.outcomes), 'failure_rate': round(self.failure_ratio(), 3),
+                'rejected': self.rejected, 'stale_probes': self.stale_probes, 'transitions': dict(self.transitions)}
+
 # --- Global Variables ---
 conversations = {}
+chat_sessions = LRUCache("chat_sessions", DEFAULT_CHAT_SESSION_CACHE_SIZE, DEFAULT_CHAT_SESSION_CACHE_MAX_BYTES) # (channel_id, user_id) -> live ChatSession
+man_page_cache = LRUCache("man_pages", 128, 8 * 1024 * 1024) # "section/name" -> rendered page text
+man_key_aliases = LRUCache("man_key_aliases", 1024) # Query key ("/ls", "1/openssl-req") -> key of the host page it resolved to
+response_cache = LRUCache("responses", 0) # (model, normalized prompt) -> {'text', 'tokens'}; sized in main() when enabled
+local_man_dirs = [] # Set in main() from the host's manpath
+man_binary = None # Path to man(1) used for rendering; None disables local pages
+man_render_semaphore = None # Bounds concurrent renders; created on first use inside the loop
+man_request_counts = collections.Counter() # "section/name" -> times requested (persisted to MAN_STATS_FILE)
+man_stats = collections.Counter() # requests, cache_hits, prewarmed_local, prewarmed_gemini, prewarm_missing
+man_prewarm_task = None
+active_interactions = 0 # Live user interactions in progress; prewarming yields while non-zero
+event_loop_name = None # Engine actually running the bot (set in main)
+tracemalloc_previous_snapshot = None # Baseline for the next diagnostics dump diff
+diagnostics_tasks = set() # Running SIGUSR1 dumps (strong references, so they are not garbage-collected mid-write)
+pending_prompts = {} # (channel_id, user_id) -> prompts collected during the current debounce window
+metrics = collections.Counter() # Runtime counters (reported in diagnostics dumps)
+gemini_breaker = CircuitBreaker("gemini") # Sized and hooked up in main()
+GEMINI_UNAVAILABLE_REPLY = "The AI service is temporarily unavailable. Please try again shortly."
+gemini_status_reply = GEMINI_UNAVAILABLE_REPLY # Fail-fast reply while open (refreshed with the retry time on opening)
+gemini_keepalive_task = None
+gemini_last_activity = None # time.monotonic() of the last Gemini round trip (requests, warm-up, keepalives)
+gemini_first_chunk_seconds = {'cold': collections.deque(maxlen=200), 'warm': collections.deque(maxlen=200)} # Recent samples
+inflight_interactions = {} # Triggering message ID -> in-flight interaction (task, messages, progress)
+conversation_lanes = {} # (channel_id, user_id) -> {'lock', 'depth'}: ordered execution per conversation; removed when idle
 config = {}
 discord_client = None
-gemini_model = None
+gemini_model = None # 'general' profile model (also used for warm-up/keepalive)
+gemini_models = {} # Profile name -> GenerativeModel with that profile's generation config and system instruction
 # Man page content template (formatted in on_ready)
 BASE_BOT_MAN_PAGE_CONTENT = """
 NAME
@@ -135,6 +667,7 @@ SYNOPSIS
     @{bot_name} <prompt>
     @{bot_name} man <command_name>
     @{bot_name} man @{bot_name}
+    @{bot_name} summarize [text]
     @{bot_name} help
     @{bot_name} botsnack | bot snack
 
@@ -146,13 +679,18 @@ DESCRIPTION
 COMMANDS
     <prompt>
         When you mention the bot followed by any text (not matching the commands below), the text is treated as a prompt and sent to the Gemini AI for a response.
+        Deleting your message while the bot is still answering stops the answer; editing it restarts the answer with the edited text.
+        Answers are limited in length; if an answer is cut off at that limit, the bot says so.
 
-    man <command_name>
-        Requests the standard manual page content for the specified <command_name>. The bot asks the Gemini AI to generate this content. If the AI cannot find or generate the man page, a standard 'no manual entry' error is returned.
+    man [section] <command_name>
+        Requests the standard manual page for the specified <command_name>. If the page is installed on the host running the bot it is rendered and sent directly. Otherwise the bot asks the Gemini AI to generate this content. If the AI cannot find or generate the man page, a standard 'no manual entry' error is returned.
 
     man @{bot_name}
         Displays this man page, providing detailed documentation on how to use the bot.
 
+    summarize [text]
+        Asks the Gemini AI for a short bullet-point summary of <text>. Without text, reply to a message with `@{bot_name} summarize` to summarize that message.
+
     help
         Displays a short message directing you to use the `man @{bot_name}` command for full help.
 
@@ -166,6 +704,8 @@ CONVERSATION HISTORY
     - Current Timeout: {timeout_seconds} seconds ({timeout_delta}).
     - Mentioning the bot or receiving a response resets the timer for that specific conversation thread.
     - History is specific to a user AND channel.
+    - If the bot runner enables it, several prompts sent in quick succession are merged and answered as one question.
+    - Further prompts sent while the bot is still answering you in that channel wait their turn and are answered in order, each with the previous answers as context. Only a few can wait at once; extra ones are declined.
     - All history is lost when the bot program restarts.
 
 CONFIGURATION (For Bot Runner)
@@ -175,11 +715,12 @@ EXAMPLES
     @{bot_name} What is the airspeed velocity of an unladen swallow?
     @{bot_name} man systemd
     @{bot_name} man @{bot_name}
+    @{bot_name} summarize <long text to condense>
     @{bot_name} help
     @{bot_name} botsnack
 
 NOTES
-    Powered by `google-generativeai` and `discord.py`. AI responses depend on the underlying Gemini model. Requires specific Discord Intents (Messages, Message Content, Guilds). Ensure the bot has appropriate permissions in the channels it operates in. Check service logs for detailed operational information (e.g., using `journalctl -u {app_name}`).
+    Powered by `google-generativeai` and `discord.py`. AI responses depend on the underlying Gemini model. Requires specific Discord Intents (Messages, Message Content, Guilds). Ensure the bot has appropriate permissions in the channels it operates in; very long answers and man pages are sent as a text file with a short preview, which needs the Attach Files permission (without it they are split into messages). Check service logs for detailed operational information (e.g., using `journalctl -u {app_name}`).
 """
 BOT_MAN_PAGE_CONTENT = "Bot man page content loading..."
 
@@ -236,8 +777,334 @@ def get_relevant_history(channel_id, user_id, current_time_utc):
     logger.debug(f"Using {len(gemini_api_history)} relevant history messages for {history_key}")
     return gemini_api_history
 
+# --- Live Chat Session Reuse ---
+def history_text_bytes(history):
+    """Estimates the memory held by a list of stored/API history messages from their text size."""
+    return sum(len(part.get('text', '')) for msg in history for part in msg['parts'])
+
+def prune_expired_chat_sessions(current_time_utc):
+    """Drops sessions idle longer than the conversation timeout (oldest-used first, so stop at the first live one)."""
+    while True:
+        oldest = chat_sessions.oldest()
+        if oldest is None or current_time_utc - oldest[1]['last_activity'] <= config['CONVERSATION_TIMEOUT_DELTA']: return
+        chat_sessions.pop(oldest[0])
+        logger.debug(f"Chat session for {oldest[0]} expired.")
+
+def get_chat_session(history_key, relevant_history, current_time_utc, profile='general'):
+    """Returns (chat, reused): the cached ChatSession if it still mirrors the stored history and profile, else a new one."""
+    prune_expired_chat_sessions(current_time_utc)
+    entry = chat_sessions.get(history_key)
+    if entry is not None:
+        stored_turns = len(conversations.get(history_key, []))
+        # Reuse only if nothing was added/expired/trimmed since the session last replied, and with the same model settings
+        if relevant_history and entry['stored_turns'] == stored_turns and entry['history_len'] == len(relevant_history) and entry['profile'] == profile:
+            return entry['chat'], True
+        chat_sessions.pop(history_key)
+        logger.debug(f"Chat session for {history_key} no longer matches stored history or profile. Rebuilding.")
+    return profile_model(profile).start_chat(history=relevant_history), False
+
+def remember_chat_session(history_key, chat, history_len, current_time_utc, profile='general'):
+    """Caches a session after a successful exchange so the next follow-up can append to it."""
+    stored_history = conversations.get(history_key, [])
+    chat_sessions.put(history_key, {'chat': chat, 'stored_turns': len(stored_history), 'history_len': history_len, 'profile': profile,
+                                    'last_activity': current_time_utc}, size=history_text_bytes(stored_history[-history_len:]))
+
+# --- Generation Profiles ---
+def build_profile_model(model_name, settings):
+    """Creates a GenerativeModel with a profile's output cap, temperature, stop sequences and system instruction."""
+    generation_config = {}
+    if settings['max_output_tokens']: generation_config['max_output_tokens'] = settings['max_output_tokens']
+    if settings['temperature'] is not None: generation_config['temperature'] = settings['temperature']
+    if settings['stop_sequences']: generation_config['stop_sequences'] = settings['stop_sequences']
+    return genai.GenerativeModel(model_name, generation_config=generation_config or None,
+                                 system_instruction=settings['system_instruction'] or None)
+
+def profile_model(profile):
+    """Returns the model for a generation profile (the general model if the profile has none, e.g. offline fakes)."""
+    return gemini_models.get(profile) or gemini_model
+
+def finish_reason_name(response):
+    """Returns the first candidate's finish reason name (e.g. 'STOP', 'MAX_TOKENS') from a response or chunk, or None."""
+    candidates = getattr(response, 'candidates', None)
+    if not candidates: return None
+    reason = getattr(candidates[0], 'finish_reason', None)
+    return getattr(reason, 'name', None) if reason else None
+
+def truncation_note(profile):
+    """Note appended to replies that hit the profile's output token cap."""
+    cap = config.get('GENERATION_PROFILES', {}).get(profile, {}).get('max_output_tokens')
+    return f"*(Reply cut off at the {cap}-token limit for {profile} replies.)*" if cap else "*(Reply cut off at the model's output limit.)*"
+
+# --- Local Man Pages ---
+def discover_manpath():
+    """Returns the existing man directories from MAN_PAGE_PATH, `manpath`, $MANPATH or the defaults."""
+    search_path = config.get('MAN_PAGE_PATH')
+    if not search_path and shutil.which('manpath'):
+        try:
+            result = subprocess.run(['manpath', '-q'], capture_output=True, text=True, timeout=5)
+            if result.returncode == 0: search_path = result.stdout.strip()
+        except (OSError, subprocess.SubprocessError) as e:
+            logger.debug(f"Could not run manpath: {e}")
+    search_path = search_path or os.getenv("MANPATH", "").strip(':') or DEFAULT_MANPATH
+    return [d for d in dict.fromkeys(search_path.split(':')) if d and os.path.isdir(d)]
+
+def parse_man_query(man_query):
+    """Parses 'name', 'section name' or 'name(section)'. Returns (section, name), or None if not a page name."""
+    match = MAN_QUERY_PATTERN.match(man_query.strip())
+    if not match: return None
+    return (match.group('section') or match.group('paren_section') or ''), match.group('name')
+
+def locate_man_page(name, section, man_dirs):
+    """Finds the (possibly compressed) source file for a man page. Blocking; run in a worker thread."""
+    sections = (section,) if section else MAN_SECTION_ORDER
+    for man_dir in man_dirs:
+        for sec in sections:
+            for sec_dir in dict.fromkeys((f"man{sec}", f"man{sec[0]}")):
+                base = os.path.join(man_dir, sec_dir, f"{name}.{sec}")
+                for suffix in MAN_PAGE_SUFFIXES:
+                    if os.path.isfile(base + suffix): return base + suffix
+                # Suffixed sections (openssl-req.1ossl, SSL_read.3ossl, *.3pm): man-db matches man<sec>/<name>.<sec>*
+                for path in sorted(glob.glob(glob.escape(base) + '*')):
+                    if MAN_SECTION_SUFFIX_PATTERN.match(path[len(base):]) and os.path.isfile(path): return path
+    return None
+
+async def render_man_page(path):
+    """Renders a man page file to plain text with `man -l`, bounded by MAN_RENDER_CONCURRENCY."""
+    global man_render_semaphore
+    if man_render_semaphore is None: man_render_semaphore = asyncio.Semaphore(config.get('MAN_RENDER_CONCURRENCY', 2))
+    env = dict(os.environ, MANWIDTH=str(config.get('MAN_RENDER_WIDTH', 80)), MANPAGER='cat', PAGER='cat', GROFF_NO_SGR='1')
+    env.pop('MAN_KEEP_FORMATTING', None)
+    async with man_render_semaphore:
+        try:
+            proc = await asyncio.create_subprocess_exec(man_binary, '-l', path, stdout=asyncio.subprocess.PIPE,
+                                                        stderr=asyncio.subprocess.DEVNULL, stdin=asyncio.subprocess.DEVNULL, env=env)
+        except OSError as e:
+            logger.error(f"Could not start {man_binary} to render {path}: {e}")
+            return None
+        try:
+            stdout, _ = await asyncio.wait_for(proc.communicate(), timeout=config.get('MAN_RENDER_TIMEOUT_SECONDS', 10.0))
+        except asyncio.TimeoutError:
+            logger.warning(f"Rendering {path} timed out.")
+            return None
+        finally:
+            if proc.returncode is None: # Timed out or cancelled; don't leave the renderer running
+                proc.kill(); await proc.wait()
+    if proc.returncode != 0:
+        logger.warning(f"Rendering {path} failed (exit {proc.returncode}).")
+        return None
+    text = MAN_FORMATTING_PATTERN.sub('', stdout.decode('utf-8', errors='replace')).strip()
+    return text or None
+
+def man_cache_key(man_query):
+    """Returns the cache key ("section/name") for a plain page query, or None for free-form queries.
+
+    Queries already resolved to a host page use that page's key, so "ls", "ls(1)" and "1 ls" share one entry.
+    """
+    parsed = parse_man_query(man_query)
+    if not parsed: return None
+    query_key = f"{parsed[0]}/{parsed[1]}"
+    return man_key_aliases.get(query_key) or query_key
+
+def man_page_section(path, name):
+    """Returns the section a man page file belongs to, from its file name (".../man1/openssl-req.1ossl.gz" -> "1ossl")."""
+    filename = os.path.basename(path)
+    for suffix in MAN_PAGE_SUFFIXES:
+        if suffix and filename.endswith(suffix): filename = filename[:-len(suffix)]; break
+    return filename[len(name) + 1:]
+
+def cache_man_page(man_query, page_text, source):
+    """Caches a man page obtained from `source` ('local' or 'gemini')."""
+    cache_key = man_cache_key(man_query)
+    if cache_key and page_text:
+        man_page_cache.put(cache_key, {'text': page_text, 'source': source}, size=len(page_text))
+
+async def lookup_man_page(man_query, live=True):
+    """Returns (page_text, source) from the cache or the host's man pages, or (None, None) if Gemini is needed."""
+    cache_key = man_cache_key(man_query)
+    if cache_key is None: return None, None # Not a plain page name; let Gemini handle it
+    with tracer.span("man.local_lookup", **{'man.page': cache_key}) as span:
+        cached = man_page_cache.get(cache_key)
+        span.set_attribute('man.cached', cached is not None)
+        if cached is not None:
+            if live: man_stats['cache_hits'] += 1
+            return cached['text'], cached['source']
+        if not man_binary or not local_man_dirs: return None, None
+        section, name = cache_key.split('/', 1)
+        path = await asyncio.get_running_loop().run_in_executor(None, locate_man_page, name, section, local_man_dirs)
+        span.set_attribute('man.found', path is not None)
+        if not path: return None, None
+        resolved_key = f"{man_page_section(path, name)}/{name}"
+        if resolved_key != cache_key: # e.g. "/ls" or "1/openssl-req": remember the page it resolves to
+            man_key_aliases.put(cache_key, resolved_key)
+            cached = man_page_cache.get(resolved_key) # Already rendered for another spelling of the query
+            if cached is not None:
+                if live: man_stats['cache_hits'] += 1
+                return cached['text'], cached['source']
+        page_text = await render_man_page(path)
+        if not page_text: return None, None
+        cache_man_page(man_query, page_text, 'local')
+        return page_text, 'local'
+
+# --- Man Page Prewarming ---
+def load_man_request_stats(path):
+    """Loads persisted man page request counts (learned popularity) into man_request_counts."""
+    if not path or not os.path.isfile(path): return
+    try:
+        with open(path, 'r', encoding='utf-8') as f: counts = json.load(f).get('counts', {})
+        man_request_counts.update({k: int(v) for k, v in counts.items() if isinstance(k, str) and '/' in k})
+        logger.info(f"Loaded request counts for {len(counts)} man page(s) from {path}.")
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        logger.warning(f"Could not load man page request stats from {path}: {e}")
+
+def save_man_request_stats(path):
+    """Atomically writes the most requested man pages to disk. Blocking; run off the event loop when live."""
+    if not path or not man_request_counts: return
+    temp_path = f"{path}.tmp"
+    try:
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({'saved_at': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                       'counts': dict(man_request_counts.most_common(MAN_STATS_MAX_PAGES))}, f)
+        os.replace(temp_path, path)
+        logger.debug(f"Saved man page request stats to {path}.")
+    except OSError as e:
+        logger.warning(f"Could not save man page request stats to {path}: {e}")
+
+def man_prewarm_candidates():
+    """Returns the configured prewarm pages followed by the learned top-N requested pages (deduplicated)."""
+    learned = []
+    for cache_key, _ in man_request_counts.most_common(config.get('MAN_PREWARM_TOP_N', 0)):
+        section, name = cache_key.split('/', 1)
+        learned.append(f"{section} {name}" if section else name)
+    candidates = {}
+    for query in config.get('MAN_PREWARM_PAGES', []) + learned:
+        cache_key = man_cache_key(query)
+        if cache_key and cache_key not in candidates: candidates[cache_key] = query
+    return list(candidates.values())
+
+async def wait_until_idle():
+    """Waits until no live user interaction is running, so prewarming never competes with users."""
+    while active_interactions > 0:
+        await asyncio.sleep(0.5)
+
+async def generate_man_page(man_query):
+    """Asks Gemini (without history) for a man page. Returns the page text, or None if no page exists."""
+    global gemini_last_activity
+    try:
+        response = await profile_model('man').generate_content_async(man_query) # Instructions are in the 'man' profile
+    except google_api_exceptions.GoogleAPIError:
+        gemini_breaker.record(True); raise
+    gemini_breaker.record(False); gemini_last_activity = time.monotonic()
+    page_text = (response.text or "").strip()
+    if not page_text or page_text == f"man: no manual entry for {man_query}": return None
+    if finish_reason_name(response) == 'MAX_TOKENS': # Don't cache a cut-off page; a user request regenerates it with a note
+        logger.info(f"Generated man page for '{man_query}' hit the output token cap. Not caching it."); return None
+    return page_text
+
+async def prewarm_man_pages():
+    """Fills the man page cache in the background at low priority, then periodically saves request stats."""
+    candidates = man_prewarm_candidates()
+    if candidates:
+        logger.info(f"Prewarming {len(candidates)} man page(s) (concurrency {config['MAN_PREWARM_CONCURRENCY']}).")
+        started = time.monotonic(); done = 0
+        semaphore = asyncio.Semaphore(config['MAN_PREWARM_CONCURRENCY'])
+        gemini_lock = asyncio.Lock(); last_gemini_call = [0.0]
+
+        async def prewarm_one(man_query):
+            nonlocal done
+            async with semaphore:
+                await wait_until_idle()
+                try:
+                    page_text, source = await lookup_man_page(man_query, live=False)
+                    if page_text is None and gemini_model and gemini_breaker.state == CircuitBreaker.CLOSED: # Leave probes to users
+                        async with gemini_lock: # Serialize and space out Gemini calls (rate limits)
+                            await asyncio.sleep(max(0.0, last_gemini_call[0] + config['MAN_PREWARM_GEMINI_INTERVAL_SECONDS'] - time.monotonic()))
+                            await wait_until_idle()
+                            last_gemini_call[0] = time.monotonic()
+                            page_text = await generate_man_page(man_query)
+                        source = 'gemini'
+                        cache_man_page(man_query, page_text, source)
+                    man_stats[f"prewarmed_{source}" if page_text else 'prewarm_missing'] += 1
+                except Exception as e: # One bad page must not stop the rest
+                    logger.warning(f"Prewarm failed for man page '{man_query}': {type(e).__name__} - {e}")
+                    man_stats['prewarm_errors'] += 1
+                done += 1
+                logger.debug(f"Prewarm progress {done}/{len(candidates)}: '{man_query}'")
+
+        await asyncio.gather(*(prewarm_one(q) for q in candidates))
+        logger.info(f"Man page prewarm finished in {time.monotonic() - started:.1f}s: "
+                    f"{man_stats['prewarmed_local']} local, {man_stats['prewarmed_gemini']} generated, "
+                    f"{man_stats['prewarm_missing']} missing, {man_stats['prewarm_errors']} failed. Cache: {man_page_cache.stats()}")
+    # Persist learned popularity periodically (runs for the life of the bot)
+    saved_total = sum(man_request_counts.values())
+    while True:
+        await asyncio.sleep(config['MAN_STATS_SAVE_INTERVAL_SECONDS'])
+        total = sum(man_request_counts.values())
+        if total != saved_total:
+            await asyncio.get_running_loop().run_in_executor(None, save_man_request_stats, config['MAN_STATS_FILE'])
+            saved_total = total
+        if man_stats['requests']:
+            logger.info(f"Man page cache hit rate: {man_stats['cache_hits']}/{man_stats['requests']} "
+                        f"({man_stats['cache_hits'] / man_stats['requests']:.0%}).")
+
+def man_history_text(man_query, page_text):
+    """Conversation history stand-in for a man page served without Gemini: a marker and the page's opening lines."""
+    excerpt = attachment_preview(page_text, MAN_HISTORY_EXCERPT_CHARS)
+    if len(excerpt) == len(page_text): return page_text
+    return f"[Man page for {man_query} shown ({len(page_text)} characters). It begins:]\n{excerpt}\n[…]"
+
+def record_interaction(history_key, message, prompt_content, response_text):
+    """Appends the user's prompt and the bot's reply to the conversation history. Returns the reply timestamp."""
+    with tracer.span("history_write"):
+        user_message_timestamp = message.created_at.replace(tzinfo=datetime.timezone.utc)
+        response_timestamp = datetime.datetime.now(datetime.timezone.utc)
+        # Store the original user prompt content, not the modified gemini_prompt for man
+        user_msg_data = {'role': 'user', 'parts': [{'text': prompt_content}], 'timestamp': user_message_timestamp}
+        model_msg_data = {'role': 'model', 'parts': [{'text': response_text}], 'timestamp': response_timestamp}
+
+        if history_key not in conversations: conversations[history_key] = []
+        conversations[history_key].extend([user_msg_data, model_msg_data])
+        logger.debug(f"Stored interaction ({len(prompt_content)}b -> {len(response_text)}b) for {history_key}")
+    return response_timestamp
+
+def attachment_filename(kind, name=""):
+    """Builds a safe file name for an attached reply by kind (generation profile): .man pages, .md answers, .txt otherwise (summaries)."""
+    extension = {'man': 'man', 'general': 'md'}.get(kind, 'txt')
+    stem = re.sub(r'[^\w.-]+', '_', name).strip('._')[:64] or ('summary' if kind == 'summarize' else 'response')
+    return f"{stem}.{extension}"
+
+def attachment_preview(text, limit):
+    """Returns the first lines of text, cut at a line break within limit characters."""
+    if len(text) <= limit: return text
+    cut = text.rfind('\n', 0, limit)
+    return text[:cut if cut > limit // 2 else limit].rstrip()
+
+async def send_text_attachment(channel, text, filename, note):
+    """Uploads text once as an in-memory file, with a short note as the message content."""
+    data = text.encode('utf-8')
+    with tracer.span("discord.send_attachment", **{'message.length': len(text), 'attachment.bytes': len(data)}):
+        try:
+            await channel.send(content=note, file=discord.File(io.BytesIO(data), filename=filename))
+            metrics['attachments_sent'] += 1; metrics['attachment_bytes'] += len(data)
+            logger.debug(f"Sent {len(data)} byte attachment '{filename}' to C:{channel.id}")
+            return True
+        except (discord.Forbidden, discord.HTTPException) as e: # No Attach Files permission, or upload rejected
+            logger.warning(f"Could not attach '{filename}' in C:{channel.id} ({e}). Sending as messages.")
+            return False
+
+async def send_response(channel, text, kind='general', name=""):
+    """Sends a reply: man pages in a code block, and anything over ATTACHMENT_THRESHOLD_CHARS as one file."""
+    threshold = config.get('ATTACHMENT_THRESHOLD_CHARS', 0)
+    if threshold and len(text) > threshold:
+        filename = attachment_filename(kind, name)
+        preview = attachment_preview(text, config.get('ATTACHMENT_PREVIEW_CHARS', 400))
+        if kind == 'man': preview = f"```man\n{preview}\n```"
+        note = f"{preview}\n*…full text ({len(text)} characters) attached as `{filename}`.*" if preview else f"*Full text ({len(text)} characters) attached as `{filename}`.*"
+        if await send_text_attachment(channel, text, filename, note): return
+    await send_split_message(channel, f"```man\n{text}\n```" if kind == 'man' else text)
+
 async def send_split_message(channel, text):
     """Sends potentially long messages, splitting respecting code blocks."""
+    span = tracer.start_span("discord.send_split_message", **{'message.length': len(text)})
     try:
         in_code_block = False; block_prefix = ""; block_suffix = "\n```"; text_inside = text
         # Improved code block detection
@@ -289,6 +1156,8 @@ async def send_split_message(channel, text):
                 msg_count += 1
                 if current_pos < len(text): # Delay only if more chunks are coming
                     await asyncio.sleep(0.5)
+                    span.set_attribute('message.sleep_seconds', 0.5 * msg_count)
+        span.set_attribute('message.chunks', msg_count)
         if msg_count > 0:
             logger.debug(f"Sent {msg_count} message chunk(s) to C:{channel.id}")
         elif len(text) > 0 : # Log if text existed but no chunks were sent (should be rare)
@@ -301,12 +1170,140 @@ async def send_split_message(channel, text):
         logger.error(f"Discord HTTP error sending message to C:{channel.id}: {e.status} {e.code} {e.text}")
     except Exception as e:
         logger.error(f"Error in send_split_message to C:{channel.id}: {e}", exc_info=True)
-
+        span.set_error(e)
+    finally:
+        span.end()
+
+
+# --- In-flight Interaction Tracking (cancel on message delete/edit) ---
+def track_interaction(message):
+    """Registers the current task as the interaction answering `message`, so it can be cancelled."""
+    interaction = {'task': asyncio.current_task(), 'messages': [message], 'cancel_reason': None,
+                   'generated_chars': 0, 'generated_tokens': 0,
+                   'source': None, 'response_chars': 0, 'first_chunk_ms': None, 'generation_ms': None} # How it was answered (traffic capture)
+    inflight_interactions[message.id] = interaction
+    return interaction
+
+def adopt_interaction_message(interaction, message):
+    """Points a merged (debounced) message at the interaction that will answer it."""
+    interaction['messages'].append(message)
+    inflight_interactions[message.id] = interaction
+
+def untrack_interaction(interaction):
+    for msg in interaction['messages']:
+        if inflight_interactions.get(msg.id) is interaction: del inflight_interactions[msg.id]
+
+async def cancel_interaction(message_id, reason):
+    """Cancels the in-flight interaction for a message and waits for it to stop. Returns it, or None."""
+    interaction = inflight_interactions.get(message_id)
+    if interaction is None or interaction['task'] is None or interaction['task'].done(): return None
+    interaction['cancel_reason'] = reason
+    metrics[f"interactions_{reason}"] += 1
+    interaction['task'].cancel()
+    await asyncio.wait({interaction['task']})
+    return interaction
+
+async def restart_interaction_messages(messages):
+    """Re-runs on_message for the given messages concurrently (so they can be debounced together again)."""
+    if messages: await asyncio.gather(*(on_message(msg) for msg in messages))
+
+def note_interaction(interaction, **fields):
+    """Records how an interaction was answered (source, sizes, timings); no-op without a tracked interaction."""
+    if interaction is not None: interaction.update(fields)
+
+def capture_command(prompt_lower):
+    """Classifies a mention's prompt for traffic capture (mirrors the command parsing in on_message/handle_prompt)."""
+    if prompt_lower in ("botsnack", "bot snack", "help"): return prompt_lower.replace(" ", "")
+    if prompt_lower.startswith("man "): return 'man'
+    if prompt_lower == "summarize" or prompt_lower.startswith("summarize "): return 'summarize'
+    return 'general' if prompt_lower else 'empty'
+
+def capture_prompt_fields(command, prompt_content):
+    """Keyed hashes of a prompt ('p') or man page ('k'), so --replay repeats them (and hits the caches) without storing text."""
+    if command == 'man':
+        man_query = prompt_content[len("man "):].strip()
+        return {'k': capture.anonymize(man_cache_key(man_query) or normalize_prompt(man_query))}
+    text = prompt_content[len("summarize"):] if command == 'summarize' else prompt_content if command == 'general' else ""
+    normalized = normalize_prompt(text)
+    return {'p': capture.anonymize(normalized)} if normalized else {}
+
+async def on_message_delete(message):
+    """Stops answering a deleted mention; prompts merged with it are answered without it."""
+    if capture.enabled: capture.record('del', id=capture.anonymize(message.id))
+    interaction = await cancel_interaction(message.id, 'deleted')
+    if interaction is None: return
+    logger.info(f"Mention {message.id} deleted while being answered. Cancelled.")
+    await restart_interaction_messages([msg for msg in interaction['messages'] if msg.id != message.id])
+
+async def on_message_edit(before, after):
+    """Restarts an in-flight answer with the edited prompt."""
+    if before.content == after.content: return # Embed/preview updates also fire edit events
+    if capture.enabled: capture.record('edit', id=capture.anonymize(after.id), n=len(after.content))
+    interaction = await cancel_interaction(after.id, 'edited')
+    if interaction is None: return
+    logger.info(f"Mention {after.id} edited while being answered. Restarting with the edited prompt.")
+    await restart_interaction_messages([after if msg.id == after.id else msg for msg in interaction['messages']])
+
+# --- Conversation Lanes (ordered execution per channel/user) ---
+def lane_queue_full(history_key):
+    """True if this conversation already has LANE_MAX_QUEUED requests waiting behind the running one."""
+    lane = conversation_lanes.get(history_key)
+    return lane is not None and lane['depth'] - 1 >= config.get('LANE_MAX_QUEUED', 3)
+
+@contextlib.asynccontextmanager
+async def conversation_lane(history_key):
+    """Runs interactions for one (channel, user) one at a time, in arrival order; other keys are unaffected."""
+    lane = conversation_lanes.get(history_key)
+    if lane is None:
+        lane = conversation_lanes[history_key] = {'lock': asyncio.Lock(), 'depth': 0}
+    lane['depth'] += 1 # Running + queued
+    if lane['depth'] > 1: metrics['lane_waits'] += 1
+    metrics['lane_max_depth'] = max(metrics['lane_max_depth'], lane['depth'])
+    try:
+        async with lane['lock']: # asyncio.Lock wakes waiters in FIFO order
+            yield
+    finally:
+        lane['depth'] -= 1
+        if lane['depth'] == 0 and conversation_lanes.get(history_key) is lane:
+            del conversation_lanes[history_key] # Idle: reclaim
+
+# --- Debounce (merge rapid-fire mentions) ---
+async def debounce_prompt(message, prompt_content, interaction):
+    """Collects general prompts from one user/channel arriving within the debounce window.
+
+    The first caller waits out the window (extended by each new prompt, capped by DEBOUNCE_MAX_SECONDS)
+    and gets back (messages, merged_prompt). Later callers inside the window get None: their prompt
+    was merged into the first caller's request.
+    """
+    history_key = (message.channel.id, message.author.id)
+    loop = asyncio.get_running_loop(); now = loop.time()
+    pending = pending_prompts.get(history_key)
+    if pending is not None and len(pending['messages']) < config['DEBOUNCE_MAX_MESSAGES']:
+        pending['messages'].append(message); pending['prompts'].append(prompt_content)
+        adopt_interaction_message(pending['interaction'], message) # Deleting/editing it now affects the merged request
+        pending['deadline'] = min(now + config['DEBOUNCE_SECONDS'], pending['started'] + config['DEBOUNCE_MAX_SECONDS'])
+        metrics['debounce_merged'] += 1
+        logger.debug(f"Merged prompt into pending request for {history_key} ({len(pending['messages'])} messages).")
+        return None
+    if pending is not None: # Window is full; this prompt starts its own request
+        return [message], prompt_content
+    pending = {'messages': [message], 'prompts': [prompt_content], 'started': now, 'deadline': now + config['DEBOUNCE_SECONDS'], 'interaction': interaction}
+    pending_prompts[history_key] = pending
+    try:
+        remaining = pending['deadline'] - now
+        while remaining > 0:
+            await asyncio.sleep(remaining)
+            remaining = pending['deadline'] - loop.time()
+    finally:
+        if pending_prompts.get(history_key) is pending: del pending_prompts[history_key]
+    if len(pending['messages']) > 1:
+        logger.info(f"Debounced {len(pending['messages'])} prompts from {history_key} into one request.")
+    return pending['messages'], "\n".join(pending['prompts'])
 
 # --- Discord Event Handlers ---
 async def on_ready():
     """Called when the bot successfully connects and is ready."""
-    global BOT_MAN_PAGE_CONTENT, discord_client, config, APP_NAME
+    global BOT_MAN_PAGE_CONTENT, discord_client, config, APP_NAME, man_prewarm_task, gemini_keepalive_task
     if not discord_client or not discord_client.user:
         logger.error("Internal error: Discord client not ready in on_ready handler.")
         return
@@ -323,18 +1320,97 @@ async def on_ready():
             app_name=APP_NAME # Pass app name for journalctl example
         )
         logger.debug("Bot Man Page content formatted.")
-        # Set Discord presence/status
-        status_name = f"man @{discord_client.user.name}"
-        await discord_client.change_presence(activity=discord.Activity(type=discord.ActivityType.listening, name=status_name))
-        logger.info(f"Set status: Listening to {status_name}")
+        # Set Discord presence/status (also reflects Gemini health, see on_gemini_breaker_change)
+        await update_presence()
     except Exception as e:
         logger.error(f"Error during on_ready tasks (status/help format): {e}", exc_info=True)
 
+    # Gemini connection warm-up and idle keepalives (once per process; on_ready also fires after reconnects)
+    if gemini_keepalive_task is None and (config.get('GEMINI_WARMUP') or config.get('GEMINI_KEEPALIVE_SECONDS')):
+        gemini_keepalive_task = asyncio.create_task(gemini_keepalive())
+
+    # Background man page prewarm (once per process; on_ready also fires after reconnects)
+    if config.get('MAN_PREWARM') and man_prewarm_task is None:
+        man_prewarm_task = asyncio.create_task(prewarm_man_pages())
+
+# --- Gemini Health (circuit breaker state in logs, metrics and presence) ---
+async def update_presence():
+    """Sets the bot's status: listening to its man page, flagged while Gemini is unavailable or recovering."""
+    status_name = f"man @{discord_client.user.name}"; status = discord.Status.online
+    if gemini_breaker.state == CircuitBreaker.OPEN:
+        status = discord.Status.dnd; status_name += " (AI unavailable)"
+    elif gemini_breaker.state == CircuitBreaker.HALF_OPEN:
+        status = discord.Status.idle; status_name += " (AI recovering)"
+    try:
+        await discord_client.change_presence(status=status, activity=discord.Activity(type=discord.ActivityType.listening, name=status_name))
+        logger.info(f"Set status: Listening to {status_name}")
+    except Exception as e: # Presence is cosmetic; never let it break a reply
+        logger.warning(f"Could not update presence: {type(e).__name__} - {e}")
+
+def on_gemini_breaker_change(old_state, new_state):
+    """Logs a breaker state change, refreshes the cached fail-fast reply and updates the presence."""
+    global gemini_status_reply
+    metrics[f"breaker_{new_state}"] += 1
+    if new_state == CircuitBreaker.OPEN:
+        retry_at = gemini_breaker.retry_at().strftime('%H:%M:%S')
+        gemini_status_reply = (f"The AI service is having trouble right now ({gemini_breaker.failure_ratio():.0%} of recent requests failed or were too slow). "
+                               f"I'll try again after {retry_at} UTC.")
+        logger.error(f"Gemini circuit breaker {old_state} -> open: {gemini_breaker.stats()}. Failing fast until {retry_at} UTC.")
+        if config.get('GEMINI_FALLBACK_MODELS'):
+            logger.error(f"If {config.get('GEMINI_MODEL_NAME')} keeps failing, benchmarked fallbacks are: {', '.join(config['GEMINI_FALLBACK_MODELS'])} (set GEMINI_MODEL_NAME and restart).")
+    else:
+        logger.warning(f"Gemini circuit breaker {old_state} -> {new_state}.")
+    if discord_client is not None and discord_client.is_ready():
+        asyncio.get_running_loop().create_task(update_presence())
+
+def gemini_connection_state():
+    """Returns 'cold' if no Gemini round trip happened recently (new connection and TLS handshake likely), else 'warm'."""
+    if gemini_last_activity is None or time.monotonic() - gemini_last_activity > GEMINI_COLD_IDLE_SECONDS: return 'cold'
+    return 'warm'
+
+def first_chunk_latency_stats():
+    """Summarizes recent cold and warm Gemini first-chunk latencies."""
+    stats = {}
+    for state, samples in gemini_first_chunk_seconds.items():
+        ordered = sorted(samples)
+        stats[state] = {'count': metrics[f"gemini_first_chunk_{state}"],
+                        'median_ms': round(ordered[len(ordered) // 2] * 1000) if ordered else None,
+                        'p90_ms': round(ordered[int(len(ordered) * 0.9)] * 1000) if ordered else None}
+    return stats
+
+async def gemini_ping(kind):
+    """Makes a cheap Gemini round trip (count_tokens) to open or keep open the connection."""
+    global gemini_last_activity
+    started = time.monotonic()
+    with tracer.span(f"gemini.{kind}", **{'gemini.model': config.get('GEMINI_MODEL_NAME')}):
+        try:
+            await asyncio.wait_for(gemini_model.count_tokens_async("ping"), timeout=30)
+            gemini_last_activity = time.monotonic(); metrics[f"gemini_{kind}s"] += 1
+            logger.log(logging.INFO if kind == 'warmup' else logging.DEBUG, f"Gemini {kind} took {(gemini_last_activity - started) * 1000:.0f}ms.")
+        except Exception as e: # Keepalives are best effort; real requests report real errors
+            metrics[f"gemini_{kind}_errors"] += 1
+            logger.warning(f"Gemini {kind} failed: {type(e).__name__} - {e}")
+
+async def gemini_keepalive():
+    """Warms the Gemini connection at startup, then pings it whenever it has been idle for GEMINI_KEEPALIVE_SECONDS."""
+    if not gemini_model: return
+    if config.get('GEMINI_WARMUP'): await gemini_ping('warmup')
+    interval = config.get('GEMINI_KEEPALIVE_SECONDS', 0)
+    while interval:
+        idle = time.monotonic() - gemini_last_activity if gemini_last_activity is not None else interval
+        if idle < interval:
+            await asyncio.sleep(interval - idle); continue # Real traffic kept it warm
+        if gemini_breaker.state == CircuitBreaker.CLOSED: # While open, probes decide; don't add load
+            await gemini_ping('keepalive')
+        if gemini_last_activity is None or time.monotonic() - gemini_last_activity >= interval:
+            await asyncio.sleep(interval) # Failed or skipped ping: retry after a full interval
+
 # This decorator needs the client instance, registered in main()
 # @discord_client.event
 async def on_message(message):
     """Handles incoming messages."""
     global discord_client, config, conversations, gemini_model, BOTSNACK_VIDEO_URL
+    received_ns = time.time_ns() # Start of the 'mention_parse' span
 
     if message.author == discord_client.user: return # Ignore self
     if not discord_client or not discord_client.user: return # Not ready
@@ -345,7 +1421,11 @@ async def on_message(message):
         mentioned = True; bot_mention_pattern = f"<@!?{discord_client.user.id}>"
         # Extract content after first mention
         prompt_content = re.sub(bot_mention_pattern, '', message.content, count=1).strip()
-    else:
+    if capture.enabled: # Ignored chatter too: it is part of the load shape
+        command = capture_command(prompt_content.lower()) if mentioned else None
+        capture.record('msg', id=capture.anonymize(message.id), g=capture.anonymize(message.guild.id), c=capture.anonymize(message.channel.id),
+                       u=capture.anonymize(message.author.id), n=len(message.content), cmd=command, **capture_prompt_fields(command, prompt_content))
+    if not mentioned:
         return # Only respond to mentions
 
     # Log mention receipt
@@ -373,8 +1453,23 @@ async def on_message(message):
              await send_split_message(message.channel, hint_message)
         return
 
+    # --- Run the prompt as a tracked, cancellable interaction (see on_message_delete/on_message_edit) ---
+    interaction = track_interaction(message)
+    try:
+        await handle_prompt(message, prompt_content, author_mention_str, received_ns, interaction)
+    finally:
+        untrack_interaction(interaction)
+        if capture.enabled:
+            capture.record('reply', id=capture.anonymize(message.id), src=interaction['source'], n=interaction['response_chars'],
+                           ms=(time.time_ns() - received_ns) // 1_000_000, ttft=interaction['first_chunk_ms'], gen=interaction['generation_ms'], x=interaction['cancel_reason'])
+
+async def handle_prompt(message, prompt_content, author_mention_str, received_ns, interaction):
+    """Handles a `man` or general prompt: local/cached man pages, debounce, then the Gemini request."""
+    global active_interactions
+    prompt_lower = prompt_content.lower(); debounce_span = None
+
     # --- Handle `man` Request Logic ---
-    is_man_request = False; man_query = ""; gemini_prompt = prompt_content
+    is_man_request = False; man_query = ""; gemini_prompt = prompt_content; profile = 'general'
     if prompt_lower.startswith("man "):
         is_man_request = True; man_query = prompt_content[len("man "):].strip()
         bot_mention_string_1 = f'<@{discord_client.user.id}>'; bot_mention_string_2 = f'<@!{discord_client.user.id}>'
@@ -393,132 +1488,425 @@ async def on_message(message):
             return
         else:
             logger.info(f"Processing 'man' request from {author_mention_str} for: '{man_query}'")
-            gemini_prompt = (f"Generate the content of the standard Linux/Unix man page for: '{man_query}'. "
-                             f"Use typical man page structure (NAME, SYNOPSIS, DESCRIPTION, OPTIONS, EXAMPLES, etc.). "
-                             f"If no standard man page exists or you cannot provide it, respond *only* with the exact text: 'man: no manual entry for {man_query}'")
+            gemini_prompt = man_query; profile = 'man' # Instructions are in the 'man' profile
+
+    # --- Handle `summarize` Command (text given, or the message being replied to) ---
+    elif prompt_lower == "summarize" or prompt_lower.startswith("summarize "):
+        profile = 'summarize'
+        gemini_prompt = prompt_content[len("summarize"):].strip() or await referenced_message_text(message)
+        if not gemini_prompt:
+            usage_msg = f"Usage: `@{discord_client.user.name} summarize <text>`, or reply to a message with `@{discord_client.user.name} summarize`"
+            await send_split_message(message.channel, usage_msg)
+            return
+        logger.info(f"Processing 'summarize' request from {author_mention_str} ({len(gemini_prompt)} characters).")
     else:
         # --- Process Regular Prompt ---
+        if config.get('DEBOUNCE_SECONDS', 0) > 0: # Commands above bypass the debounce window
+            debounce_start_ns = time.time_ns()
+            try:
+                debounced = await debounce_prompt(message, prompt_content, interaction)
+            except asyncio.CancelledError: # Deleted/edited during the window
+                record_cancelled_interaction(message, interaction)
+                raise
+            if debounced is None: # Merged into an earlier pending prompt from this user
+                note_interaction(interaction, source='merged'); return
+            debounced_messages, prompt_content = debounced
+            gemini_prompt = prompt_content
+            debounce_span = (debounce_start_ns, time.time_ns(), len(debounced_messages))
         logger.info(f"Processing general prompt from {author_mention_str}: '{prompt_content[:100]}...'")
         # gemini_prompt is already set to prompt_content
 
+    parsed_ns = time.time_ns()
+    if debounce_span: parsed_ns = debounce_span[0] # Debounce wait gets its own span
+    trace_attributes = {
+        'discord.guild.id': str(message.guild.id), 'discord.channel.id': str(message.channel.id),
+        'discord.user.id': str(message.author.id), 'gemini.model': config.get('GEMINI_MODEL_NAME', 'N/A'),
+        'yui.command': profile,
+    }
+    active_interactions += 1
+    try:
+        with tracer.span("interaction", start_ns=received_ns, **trace_attributes):
+            tracer.record_span("mention_parse", received_ns, parsed_ns)
+            if debounce_span: tracer.record_span("debounce", debounce_span[0], debounce_span[1], **{'debounce.messages': debounce_span[2]})
+            # One interaction at a time per conversation, so each one sees the previous answer in its history
+            history_key = (message.channel.id, message.author.id)
+            if lane_queue_full(history_key):
+                metrics['lane_rejected'] += 1; note_interaction(interaction, source='lane_full')
+                logger.info(f"Lane for {history_key} is full. Rejecting prompt from {author_mention_str}.")
+                await send_split_message(message.channel, f"{author_mention_str}, you already have {config.get('LANE_MAX_QUEUED', 3)} request(s) waiting here. Please wait for those answers first.")
+                return
+            lane_wait_ns = time.time_ns()
+            async with conversation_lane(history_key):
+                tracer.record_span("lane_wait", lane_wait_ns, time.time_ns())
+                # Serve cached or host man pages when available; Gemini is only the fallback
+                if is_man_request:
+                    man_stats['requests'] += 1
+                    page_text, source = await lookup_man_page(man_query)
+                    cache_key = man_cache_key(man_query) # After the lookup: resolved to the host page's key when there is one
+                    if cache_key: man_request_counts[cache_key] += 1
+                    if page_text:
+                        logger.info(f"Sending {source} man page for '{man_query}'.")
+                        note_interaction(interaction, source=f"man_{source}", response_chars=len(page_text))
+                        await send_response(message.channel, page_text, 'man', man_query)
+                        record_interaction(history_key, message, prompt_content, man_history_text(man_query, page_text)) # Not the whole page: it would be resent as history
+                        return
+                    logger.debug(f"No local man page for '{man_query}'. Asking Gemini.")
+                await process_gemini_request(message, prompt_content, gemini_prompt, author_mention_str, is_man_request, man_query, interaction, profile)
+    except asyncio.CancelledError:
+        # Message deleted/edited (or shutdown): the stream and send queue stop here and history is not written
+        record_cancelled_interaction(message, interaction)
+        raise
+    finally:
+        active_interactions -= 1
+
+def record_cancelled_interaction(message, interaction):
+    """Counts and logs a cancelled interaction, and drops its chat session (it may hold a half-finished turn)."""
+    chat_sessions.pop((message.channel.id, message.author.id))
+    wasted_tokens = interaction['generated_tokens'] or interaction['generated_chars'] // 4 # ~4 chars/token fallback
+    metrics['interactions_cancelled'] += 1; metrics['wasted_tokens'] += wasted_tokens
+    logger.info(f"Interaction for message {message.id} cancelled ({interaction['cancel_reason'] or 'shutdown'}); ~{wasted_tokens} generated token(s) discarded.")
+
+async def referenced_message_text(message):
+    """Returns the text of the message this mention replies to, or "" if it is not a reply or cannot be fetched."""
+    reference = getattr(message, 'reference', None)
+    if reference is None or reference.message_id is None: return ""
+    referenced = reference.resolved if isinstance(reference.resolved, discord.Message) else None
+    if referenced is None:
+        try:
+            referenced = await message.channel.fetch_message(reference.message_id)
+        except (discord.NotFound, discord.Forbidden, discord.HTTPException) as e:
+            logger.warning(f"Could not fetch replied-to message {reference.message_id} in C:{message.channel.id}: {e}")
+            return ""
+    return referenced.content or ""
+
+def normalize_prompt(prompt):
+    """Case/whitespace/trailing-punctuation-normalized prompt text (what the response cache matches on)."""
+    return re.sub(r'\s+', ' ', prompt).strip().lower().rstrip('?!. ')
+
+def response_cache_key(prompt):
+    """Cache key for a history-free general prompt: model plus normalized text."""
+    normalized = normalize_prompt(prompt)
+    return (config.get('GEMINI_MODEL_NAME'), normalized) if normalized else None
+
+async def start_gemini_stream(chat, prompt):
+    """Sends a streaming prompt and waits for its first chunk. Returns (first chunk or None if empty, remaining chunks)."""
+    chunks = (await chat.send_message_async(prompt, stream=True)).__aiter__()
+    try:
+        return await chunks.__anext__(), chunks
+    except StopAsyncIteration:
+        return None, chunks
+
+async def chain_first_chunk(first_chunk, chunks):
+    """Yields the already received first chunk, then the rest of the stream."""
+    if first_chunk is None: return
+    yield first_chunk
+    async for chunk in chunks: yield chunk
+
+async def process_gemini_request(message, prompt_content, gemini_prompt, author_mention_str, is_man_request=False, man_query="", interaction=None, profile='general'):
+    """Sends a prompt to Gemini (with the profile's model settings) and the user's history, delivers the reply and stores the exchange."""
+    global gemini_last_activity
+
     # --- Common Logic: Get History, Call Gemini, Handle Response ---
     current_time_utc = datetime.datetime.now(datetime.timezone.utc)
     history_key = (message.channel.id, message.author.id)
-    relevant_gemini_history = get_relevant_history(message.channel.id, message.author.id, current_time_utc)
+    with tracer.span("history_retrieval") as span:
+        relevant_gemini_history = get_relevant_history(message.channel.id, message.author.id, current_time_utc)
+        span.set_attribute('history.messages', len(relevant_gemini_history))
+
+    # --- Exact-match response cache (general prompts without history only) ---
+    cache_key = response_cache_key(prompt_content) if response_cache.max_entries and profile == 'general' and not relevant_gemini_history else None
+    cached = response_cache.get(cache_key) if cache_key else None
+    if cached is not None:
+        stats = response_cache.stats(); metrics['response_cache_saved_tokens'] += cached['tokens']
+        logger.info(f"Response cache hit for {author_mention_str} (hit rate {stats['hit_rate']:.0%}, {metrics['response_cache_saved_tokens']} tokens saved).")
+        note_interaction(interaction, source='response_cache', response_chars=len(cached['text']))
+        await send_response(message.channel, cached['text'])
+        record_interaction(history_key, message, prompt_content, cached['text']) # Follow-ups see it like any answer
+        return
 
-    async with message.channel.typing():
-        full_response = ""; interaction_successful = True; gemini_error_msg = None
-        try:
-            if not gemini_model: # Safety check
-                 raise Exception("Gemini model not initialized")
-
-            logger.debug(f"Sending prompt to Gemini (history={len(relevant_gemini_history)} msgs): '{gemini_prompt[:100]}...'")
-            chat = gemini_model.start_chat(history=relevant_gemini_history)
-            response_stream = await chat.send_message_async(gemini_prompt, stream=True)
-
-            buffer = ""; last_sent_time = asyncio.get_event_loop().time(); initial_chunk_sent = False
-            async for chunk in response_stream:
-                # Add safety checks for chunk content if API behaves unexpectedly
-                if not hasattr(chunk, 'text') or chunk.text is None: continue
-                chunk_text = chunk.text
-                buffer += chunk_text
-                full_response += chunk_text
-                current_time_loop = asyncio.get_event_loop().time()
-                # Stream intermediate results only for non-man general requests
-                if not is_man_request and ((not initial_chunk_sent and len(buffer)>0) or len(buffer) > 500 or \
-                   (current_time_loop - last_sent_time > 1.5 and len(buffer) > 0)):
-                    if buffer:
-                        await send_split_message(message.channel, buffer)
-                        buffer = "" # Clear the buffer
-                        last_sent_time = current_time_loop
-                        initial_chunk_sent = True # Mark that we've started sending
-            # Send remaining buffer for general requests if streaming occurred
-            if buffer and not is_man_request and initial_chunk_sent:
-                 await send_split_message(message.channel, buffer)
-
-            logger.debug(f"Gemini response received (length: {len(full_response)})")
-
-        # --- Specific Error Handling for Gemini/API ---
-        except genai_types.BlockedPromptException as e:
-            logger.warning(f"Gemini blocked prompt from {author_mention_str}: {e}")
-            gemini_error_msg = "Your prompt was blocked by the AI's safety filters."
-            interaction_successful = False
-        except genai_types.StopCandidateException as e:
-             logger.warning(f"Gemini stopped generation unexpectedly for {author_mention_str}: {e}. Partial response: {len(full_response)}")
-             gemini_error_msg = "The AI stopped generating the response unexpectedly."
-             interaction_successful = True # Allow storing partial history
-        except google_api_exceptions.ResourceExhausted as e:
-             logger.error(f"Gemini API quota/rate limit hit: {e}")
-             gemini_error_msg = "The AI service is currently overloaded or rate limited. Please try again later."
-             interaction_successful = False
-        except google_api_exceptions.PermissionDenied as e:
-             logger.critical(f"Gemini API permission denied (API Key invalid?): {e}")
-             gemini_error_msg = "AI service configuration error (Permissions). Contact admin."
-             interaction_successful = False
-        except google_api_exceptions.InvalidArgument as e:
-             logger.error(f"Invalid argument sent to Gemini API: {e}")
-             gemini_error_msg = "There was an issue sending the request to the AI (Invalid Argument)."
-             interaction_successful = False
-        except google_api_exceptions.GoogleAPIError as e: # Catch other google API errors
-             logger.error(f"Google API Error: {type(e).__name__} - {e}", exc_info=True)
-             gemini_error_msg = f"A Google API error occurred (`{type(e).__name__}`)."
-             interaction_successful = False
-        except Exception as e: # Catch unexpected errors during generation
-            logger.error(f"Unexpected error during Gemini communication: {e}", exc_info=True)
-            gemini_error_msg = f"An unexpected error occurred communicating with the AI (`{type(e).__name__}`)."
-            interaction_successful = False
-
-        # --- Post-Response Processing (Sending to Discord, History) ---
-        try:
-            # Send specific error message if one occurred during generation
-            if gemini_error_msg:
-                await send_split_message(message.channel, f"{author_mention_str}, {gemini_error_msg}")
-
-            # Process successful response or refusal for 'man' command
-            elif is_man_request:
-                expected_refusal = f"man: no manual entry for {man_query}"
-                if full_response.strip() == expected_refusal:
-                    await send_split_message(message.channel, expected_refusal)
-                    logger.info(f"Gemini indicated no man page for '{man_query}'.")
-                    interaction_successful = False # Failed to find man page
+    # --- Fail fast while Gemini is known to be failing (circuit breaker open, or a probe already running) ---
+    if not gemini_breaker.allow():
+        metrics['gemini_fast_failures'] += 1
+        logger.info(f"Gemini circuit breaker {gemini_breaker.state}; failing fast for {author_mention_str}.")
+        note_interaction(interaction, source='breaker')
+        status_reply = gemini_status_reply if gemini_breaker.state == CircuitBreaker.OPEN else "The AI service is recovering. Please try again in a few seconds."
+        await send_split_message(message.channel, f"{author_mention_str}, {status_reply}")
+        return
+    breaker_probe = gemini_breaker.state == CircuitBreaker.HALF_OPEN # This request decides whether the breaker closes
+    breaker_recorded = False
+    try: # Everything from allow() on: a cancelled or failed typing()/send must not leak the half-open probe slot
+        async with message.channel.typing():
+            full_response = ""; interaction_successful = True; gemini_error_msg = None; initial_chunk_sent = False; chat = None
+            stream_held = False; streamed_chars = 0 # Set once the streamed text reaches the preview size (long answers go out as a file)
+            attachment_threshold = config.get('ATTACHMENT_THRESHOLD_CHARS', 0)
+            stream_budget = config.get('ATTACHMENT_PREVIEW_CHARS', 400) or MAX_MESSAGE_LENGTH # Streamed before the final length is known
+            response_tokens = 0; finish_reason = None # Output tokens and finish reason reported by Gemini
+            breaker_failure = False; first_chunk_timed_out = False # Outcome reported to gemini_breaker
+            first_chunk_timeout = config.get('GEMINI_BREAKER_SLOW_SECONDS', 20.0) if gemini_breaker.enabled else None
+            try:
+                if not gemini_model: # Safety check
+                     raise Exception("Gemini model not initialized")
+
+                logger.debug(f"Sending prompt to Gemini (history={len(relevant_gemini_history)} msgs): '{gemini_prompt[:100]}...'")
+                with tracer.span("gemini.start_chat") as span:
+                    chat, chat_reused = get_chat_session(history_key, relevant_gemini_history, current_time_utc, profile)
+                    span.set_attribute('chat.reused', chat_reused)
+                logger.debug(f"{'Reusing' if chat_reused else 'Started'} chat session for {history_key}.")
+                request_ns = time.time_ns(); first_chunk_received = False; connection_state = gemini_connection_state()
+                # A hung or very slow call fails (and counts against the breaker) after GEMINI_BREAKER_SLOW_SECONDS
+                first_chunk, remaining_chunks = await asyncio.wait_for(start_gemini_stream(chat, gemini_prompt), timeout=first_chunk_timeout)
+
+                buffer = ""; last_sent_time = asyncio.get_event_loop().time()
+                async for chunk in chain_first_chunk(first_chunk, remaining_chunks):
+                    if not first_chunk_received:
+                        first_chunk_received = True; first_chunk_ns = time.time_ns()
+                        tracer.record_span("gemini.first_chunk", request_ns, first_chunk_ns, **{'gemini.connection': connection_state})
+                        first_chunk_seconds = (first_chunk_ns - request_ns) / 1e9
+                        note_interaction(interaction, first_chunk_ms=(first_chunk_ns - request_ns) // 1_000_000)
+                        gemini_first_chunk_seconds[connection_state].append(first_chunk_seconds); metrics[f"gemini_first_chunk_{connection_state}"] += 1
+                        gemini_last_activity = time.monotonic()
+                    usage = getattr(chunk, 'usage_metadata', None)
+                    if usage is not None and getattr(usage, 'candidates_token_count', 0): response_tokens = usage.candidates_token_count
+                    finish_reason = finish_reason_name(chunk) or finish_reason
+                    # Add safety checks for chunk content if API behaves unexpectedly
+                    if not hasattr(chunk, 'text') or chunk.text is None: continue
+                    chunk_text = chunk.text
+                    buffer += chunk_text
+                    full_response += chunk_text
+                    if interaction is not None: # Progress, so a cancellation can report what was wasted
+                        interaction['generated_chars'] = len(full_response); interaction['generated_tokens'] = response_tokens
+                    current_time_loop = asyncio.get_event_loop().time()
+                    # Stream only a preview's worth; the rest is held until the length decides between messages and one attachment
+                    if initial_chunk_sent and attachment_threshold and streamed_chars >= stream_budget:
+                        stream_held = True
+                    # Stream intermediate results only for non-man general requests
+                    if not is_man_request and not stream_held and ((not initial_chunk_sent and len(buffer)>0) or len(buffer) > 500 or \
+                       (current_time_loop - last_sent_time > 1.5 and len(buffer) > 0)):
+                        if buffer:
+                            await send_split_message(message.channel, buffer)
+                            streamed_chars += len(buffer)
+                            buffer = "" # Clear the buffer
+                            last_sent_time = current_time_loop
+                            initial_chunk_sent = True # Mark that we've started sending
+                # Send remaining buffer for general requests if streaming occurred
+                if buffer and not is_man_request and initial_chunk_sent and not stream_held:
+                     await send_split_message(message.channel, buffer)
+
+                gemini_last_activity = time.monotonic()
+                note_interaction(interaction, generation_ms=(time.time_ns() - request_ns) // 1_000_000)
+                logger.debug(f"Gemini response received (length: {len(full_response)})")
+
+            # --- Specific Error Handling for Gemini/API ---
+            except asyncio.TimeoutError:
+                logger.warning(f"No first chunk from Gemini within {first_chunk_timeout}s for {author_mention_str}. Giving up.")
+                metrics['gemini_first_chunk_timeouts'] += 1
+                interaction_successful = False
+                breaker_failure = True; first_chunk_timed_out = True
+            except genai_types.BlockedPromptException as e:
+                logger.warning(f"Gemini blocked prompt from {author_mention_str}: {e}")
+                gemini_error_msg = "Your prompt was blocked by the AI's safety filters."
+                interaction_successful = False
+            except genai_types.StopCandidateException as e:
+                 logger.warning(f"Gemini stopped generation unexpectedly for {author_mention_str}: {e}. Partial response: {len(full_response)}")
+                 gemini_error_msg = "The AI stopped generating the response unexpectedly."
+                 interaction_successful = True # Allow storing partial history
+            except google_api_exceptions.ResourceExhausted as e:
+                 logger.error(f"Gemini API quota/rate limit hit: {e}")
+                 gemini_error_msg = "The AI service is currently overloaded or rate limited. Please try again later."
+                 interaction_successful = False
+                 breaker_failure = True
+            except google_api_exceptions.PermissionDenied as e:
+                 logger.critical(f"Gemini API permission denied (API Key invalid?): {e}")
+                 gemini_error_msg = "AI service configuration error (Permissions). Contact admin."
+                 interaction_successful = False
+                 breaker_failure = True
+            except google_api_exceptions.InvalidArgument as e:
+                 logger.error(f"Invalid argument sent to Gemini API: {e}")
+                 gemini_error_msg = "There was an issue sending the request to the AI (Invalid Argument)."
+                 interaction_successful = False
+            except google_api_exceptions.GoogleAPIError as e: # Catch other google API errors
+                 logger.error(f"Google API Error: {type(e).__name__} - {e}", exc_info=True)
+                 gemini_error_msg = f"A Google API error occurred (`{type(e).__name__}`)."
+                 interaction_successful = False
+                 breaker_failure = True
+            except Exception as e: # Catch unexpected errors during generation
+                logger.error(f"Unexpected error during Gemini communication: {e}", exc_info=True)
+                gemini_error_msg = f"An unexpected error occurred communicating with the AI (`{type(e).__name__}`)."
+                interaction_successful = False
+                breaker_failure = True
+
+            # Errors and first-chunk timeouts count against the circuit breaker (blocked/invalid prompts do not)
+            gemini_breaker.record(breaker_failure, breaker_probe); breaker_recorded = True
+            if first_chunk_timed_out: # Same reply as a fast failure (with the retry time if this opened the breaker)
+                gemini_error_msg = gemini_status_reply if gemini_breaker.state == CircuitBreaker.OPEN else GEMINI_UNAVAILABLE_REPLY
+
+            note_interaction(interaction, source='gemini_error' if gemini_error_msg else 'gemini', response_chars=len(full_response))
+
+            # --- Post-Response Processing (Sending to Discord, History) ---
+            try:
+                # Send specific error message if one occurred during generation
+                if gemini_error_msg:
+                    if stream_held and full_response[streamed_chars:]: # Deliver what was generated before the stop
+                        await send_split_message(message.channel, full_response[streamed_chars:])
+                    await send_split_message(message.channel, f"{author_mention_str}, {gemini_error_msg}")
+
+                # Process successful response or refusal for 'man' command
+                elif is_man_request:
+                    expected_refusal = f"man: no manual entry for {man_query}"
+                    if full_response.strip() == expected_refusal:
+                        await send_split_message(message.channel, expected_refusal)
+                        logger.info(f"Gemini indicated no man page for '{man_query}'.")
+                        interaction_successful = False # Failed to find man page
+                    else:
+                        # Send the presumed man page content, wrapped in code block
+                        logger.info(f"Sending presumed man page content for '{man_query}'.")
+                        await send_response(message.channel, full_response.strip(), 'man', man_query)
+                        if finish_reason != 'MAX_TOKENS': cache_man_page(man_query, full_response.strip(), 'gemini') # Cut-off pages are regenerated next time
+                        # interaction_successful remains True
+
+                # Process successful general response (handle cases where streaming didn't occur)
+                elif not is_man_request and not initial_chunk_sent and full_response:
+                     await send_response(message.channel, full_response, profile) # Profile picks the file type (.md answers, .txt summaries)
+
+                # Streaming paused after the preview: attach long answers once, send the rest of shorter ones as messages
+                elif stream_held and full_response:
+                     filename = attachment_filename(profile)
+                     if len(full_response) <= attachment_threshold or \
+                        not await send_text_attachment(message.channel, full_response, filename, f"*…full response ({len(full_response)} characters) attached as `{filename}`.*"):
+                         await send_split_message(message.channel, full_response[streamed_chars:])
+
+                # Handle empty successful responses
+                elif not full_response and interaction_successful:
+                     logger.warning(f"Received empty successful response for prompt: {prompt_content[:50]}...")
+                     await send_split_message(message.channel, f"{author_mention_str}, The AI returned an empty response.")
+                     interaction_successful = False # Treat empty as not useful for history
+
+                # Say so when the reply stopped at the profile's output token cap
+                if finish_reason == 'MAX_TOKENS' and full_response and interaction_successful and not gemini_error_msg:
+                    metrics[f"truncated_{profile}"] += 1
+                    logger.info(f"Reply for {history_key} hit the '{profile}' output token cap.")
+                    await send_split_message(message.channel, truncation_note(profile))
+
+                # --- Store Interaction in History (Only if interaction was successful) ---
+                if interaction_successful:
+                    response_timestamp = record_interaction(history_key, message, prompt_content, full_response)
+                    if cache_key and not gemini_error_msg and finish_reason != 'MAX_TOKENS': # Complete answers only
+                        response_cache.put(cache_key, {'text': full_response, 'tokens': response_tokens or len(full_response) // 4}, size=len(full_response.encode('utf-8')))
+                    if chat is not None and not gemini_error_msg: # Partial (stopped) replies leave the session mid-turn
+                        remember_chat_session(history_key, chat, len(relevant_gemini_history) + 2, response_timestamp, profile)
+                    else:
+                        chat_sessions.pop(history_key)
                 else:
-                    # Send the presumed man page content, wrapped in code block
-                    logger.info(f"Sending presumed man page content for '{man_query}'.")
-                    await send_split_message(message.channel, f"```man\n{full_response.strip()}\n```")
-                    # interaction_successful remains True
-
-            # Process successful general response (handle cases where streaming didn't occur)
-            elif not is_man_request and not initial_chunk_sent and full_response:
-                 await send_split_message(message.channel, full_response)
-
-            # Handle empty successful responses
-            elif not full_response and interaction_successful:
-                 logger.warning(f"Received empty successful response for prompt: {prompt_content[:50]}...")
-                 await send_split_message(message.channel, f"{author_mention_str}, The AI returned an empty response.")
-                 interaction_successful = False # Treat empty as not useful for history
-
-            # --- Store Interaction in History (Only if interaction was successful) ---
-            if interaction_successful:
-                user_message_timestamp = message.created_at.replace(tzinfo=datetime.timezone.utc)
-                response_timestamp = datetime.datetime.now(datetime.timezone.utc)
-                # Store the original user prompt content, not the modified gemini_prompt for man
-                user_msg_data = {'role': 'user', 'parts': [{'text': prompt_content}], 'timestamp': user_message_timestamp}
-                model_msg_data = {'role': 'model', 'parts': [{'text': full_response}], 'timestamp': response_timestamp}
-
-                if history_key not in conversations: conversations[history_key] = []
-                conversations[history_key].extend([user_msg_data, model_msg_data])
-                logger.debug(f"Stored interaction ({len(prompt_content)}b -> {len(full_response)}b) for {history_key}")
-            else:
-                logger.info(f"Interaction for {history_key} not stored due to error or refusal.")
+                    chat_sessions.pop(history_key) # Session state is unreliable after a failed turn
+                    logger.info(f"Interaction for {history_key} not stored due to error or refusal.")
+
+            # Catch errors during the sending/history update phase
+            except discord.Forbidden:
+                logger.warning(f"Missing permissions to send response/update history in C:{message.channel.id}/G:{message.guild.id}")
+            except discord.HTTPException as e:
+                logger.error(f"Discord API error sending response: {e.status} {e.code} {e.text}")
+            except Exception as e:
+                logger.error(f"Error processing response/updating history: {e}", exc_info=True)
+    finally:
+        if not breaker_recorded: gemini_breaker.release(breaker_probe) # Cancelled (deleted/edited mention) or failed before an outcome
 
-        # Catch errors during the sending/history update phase
-        except discord.Forbidden:
-            logger.warning(f"Missing permissions to send response/update history in C:{message.channel.id}/G:{message.guild.id}")
-        except discord.HTTPException as e:
-            logger.error(f"Discord API error sending response: {e.status} {e.code} {e.text}")
-        except Exception as e:
-            logger.error(f"Error processing response/updating history: {e}", exc_info=True)
 
+# --- Live Diagnostics (SIGUSR1 dump, SIGUSR2 tracemalloc toggle) ---
+def toggle_tracemalloc():
+    """Starts or stops tracemalloc, so its overhead is only paid while investigating."""
+    global tracemalloc_previous_snapshot
+    if tracemalloc.is_tracing():
+        tracemalloc.stop(); tracemalloc_previous_snapshot = None
+        logger.warning("tracemalloc stopped.")
+    else:
+        tracemalloc.start(config.get('TRACEMALLOC_FRAMES', 5))
+        logger.warning(f"tracemalloc started ({config.get('TRACEMALLOC_FRAMES', 5)} frame(s)). Send SIGUSR1 to dump, SIGUSR2 to stop.")
+
+def collect_conversation_stats(top_n):
+    """Summarizes the conversation store: keys, stored turns, text bytes and the largest keys."""
+    sizes = [(history_text_bytes(history), len(history), key) for key, history in conversations.items()]
+    return {'keys': len(sizes), 'turns': sum(s[1] for s in sizes), 'bytes': sum(s[0] for s in sizes),
+            'largest': sorted(sizes, key=lambda s: s[0], reverse=True)[:top_n]}
+
+def format_task_stacks():
+    """Returns the name, state and current stack of every asyncio task. Must run on the event loop thread."""
+    out = io.StringIO()
+    tasks = sorted(asyncio.all_tasks(), key=lambda t: t.get_name())
+    out.write(f"{len(tasks)} task(s)\n")
+    for task in tasks:
+        out.write(f"\n--- {task.get_name()}: {task.get_coro()!r} ({'done' if task.done() else 'pending'})\n")
+        task.print_stack(limit=15, file=out)
+    return out.getvalue()
+
+def format_tracemalloc_report(top_n):
+    """Takes a tracemalloc snapshot and diffs it against the previous dump's snapshot. Blocking."""
+    global tracemalloc_previous_snapshot
+    if not tracemalloc.is_tracing():
+        return "tracemalloc not running (send SIGUSR2 to start it, then dump again later for a diff).\n"
+    snapshot = tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, f) for f in TRACEMALLOC_IGNORED_FILES])
+    current, peak = tracemalloc.get_traced_memory()
+    out = io.StringIO()
+    out.write(f"Traced memory: current {current} b, peak {peak} b\n")
+    if tracemalloc_previous_snapshot is None:
+        out.write(f"Top {top_n} allocation sites (no previous snapshot to diff against):\n")
+        for stat in snapshot.statistics('lineno')[:top_n]: out.write(f"  {stat}\n")
+    else:
+        out.write(f"Top {top_n} changes since previous dump:\n")
+        for stat in snapshot.compare_to(tracemalloc_previous_snapshot, 'lineno')[:top_n]: out.write(f"  {stat}\n")
+    tracemalloc_previous_snapshot = snapshot
+    return out.getvalue()
+
+def write_diagnostics_file(path, sections, top_n):
+    """Renders the tracemalloc section and writes the report to a new file. Blocking; runs in a worker thread. Returns the path used."""
+    sections.append(("tracemalloc", format_tracemalloc_report(top_n)))
+    stem, extension = os.path.splitext(path)
+    for attempt in range(100): # Never overwrite an earlier report
+        candidate = path if attempt == 0 else f"{stem}-{attempt}{extension}"
+        try:
+            f = open(candidate, 'x', encoding='utf-8')
+        except FileExistsError:
+            continue
+        with f:
+            for title, body in sections: f.write(f"===== {title} =====\n{body}\n")
+        os.chmod(candidate, 0o640)
+        return candidate
+    raise FileExistsError(f"{path} and its numbered variants already exist")
+
+async def write_diagnostics_dump():
+    """Writes a diagnostics report to DIAGNOSTICS_DIR without interrupting service."""
+    top_n = config.get('DIAGNOSTICS_TOP_N', 25)
+    now = datetime.datetime.now(datetime.timezone.utc)
+    path = os.path.join(config.get('DIAGNOSTICS_DIR') or DEFAULT_RUN_DIR, f"{APP_NAME}-diag-{now.strftime('%Y%m%dT%H%M%S.%fZ')}.txt")
+    try:
+        # Everything touching live bot state is gathered here, on the loop thread
+        process = psutil.Process()
+        conv = collect_conversation_stats(top_n)
+        summary = (f"Time: {now.isoformat()}\nPID: {process.pid}\nRSS: {process.memory_info().rss} b\n"
+                   f"Uptime: {timedelta(seconds=int(time.time() - process.create_time()))}\n"
+                   f"Event loop: {event_loop_name}\nActive interactions: {active_interactions}\n")
+        conversations_text = f"Keys: {conv['keys']}\nStored turns: {conv['turns']}\nText bytes: {conv['bytes']}\nLargest keys (bytes, turns, (channel, user)):\n"
+        conversations_text += "".join(f"  {b} b, {t} turns, {key}\n" for b, t, key in conv['largest'])
+        caches_text = "".join(f"{cache.name}: {cache.stats()}\n" for cache in (chat_sessions, man_page_cache, man_key_aliases, response_cache))
+        caches_text += f"man_request_counts: {len(man_request_counts)} page(s)\nman_stats: {dict(man_stats)}\n"
+        caches_text += f"trace spans dropped: {tracer.writer.dropped}\n"
+        caches_text += f"capture events dropped: {capture.writer.dropped}\n"
+        caches_text += f"pending debounce windows: {len(pending_prompts)}\nin-flight interactions: {len(inflight_interactions)}\n"
+        caches_text += f"conversation lanes: {len(conversation_lanes)} (deepest: {sorted(((lane['depth'], key) for key, lane in conversation_lanes.items()), reverse=True)[:top_n]})\n"
+        caches_text += f"response cache saved tokens: {metrics['response_cache_saved_tokens']}\n"
+        caches_text += f"gemini breaker: {gemini_breaker.stats()}\n"
+        caches_text += f"gemini model: {config.get('GEMINI_MODEL_NAME')} (benchmarked fallbacks: {', '.join(config.get('GEMINI_FALLBACK_MODELS', [])) or 'none'})\n"
+        caches_text += f"gemini first chunk latency: {first_chunk_latency_stats()}\n"
+        caches_text += f"counters: {dict(metrics)}\n"
+        sections = [("summary", summary), ("conversations", conversations_text), ("caches", caches_text), ("asyncio tasks", format_task_stacks())]
+        path = await asyncio.get_running_loop().run_in_executor(None, write_diagnostics_file, path, sections, top_n)
+        logger.warning(f"Diagnostics written to {path}")
+    except Exception as e:
+        logger.error(f"Could not write diagnostics dump to {path}: {e}", exc_info=True)
+
+def start_diagnostics_dump():
+    """SIGUSR1 handler: starts a dump and holds a reference to its task until it finishes (the loop only keeps weak ones)."""
+    task = asyncio.get_running_loop().create_task(write_diagnostics_dump())
+    diagnostics_tasks.add(task); task.add_done_callback(diagnostics_tasks.discard)
 
 # --- Signal Handling and Cleanup ---
 async def cleanup_shutdown():
@@ -547,24 +1935,330 @@ def handle_signal_sync(signum, frame):
     except Exception as e:
         logger.error(f"Error scheduling async cleanup from signal handler: {e}")
 
+# --- Event Loop Engine ---
+def create_event_loop(loop_name):
+    """Creates a new event loop for the requested engine, falling back to asyncio if uvloop is unavailable."""
+    if loop_name == 'uvloop':
+        if uvloop is not None:
+            return uvloop.new_event_loop(), 'uvloop'
+        logger.warning("uvloop requested but not installed (`pip install uvloop`). Falling back to asyncio.")
+    return asyncio.new_event_loop(), 'asyncio'
+
+def shutdown_event_loop(loop):
+    """Cancels leftover tasks and closes the loop (mirrors asyncio.run cleanup)."""
+    try:
+        pending = [t for t in asyncio.all_tasks(loop) if not t.done()]
+        for task in pending: task.cancel()
+        if pending:
+            loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        loop.run_until_complete(loop.shutdown_asyncgens())
+    except Exception as e:
+        logger.error(f"Error during event loop cleanup: {e}", exc_info=True)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
+
+async def run_discord_client(token):
+    """Logs in and runs the Discord client until it is closed (equivalent of discord_client.run)."""
+    async with discord_client:
+        await discord_client.start(token)
+
+# --- Offline Benchmark Harness ---
+# Minimal stand-ins for the Discord and Gemini objects used by on_message, so the
+# event handling path can be exercised without network access or credentials.
+class FakeDiscordUser:
+    def __init__(self, user_id, name, bot=False):
+        self.id = user_id; self.name = name; self.display_name = name; self.bot = bot
+
+    def mentioned_in(self, message):
+        return f"<@{self.id}>" in message.content or f"<@!{self.id}>" in message.content
+
+class FakeDiscordGuild:
+    def __init__(self, guild_id):
+        self.id = guild_id
+
+class FakeDiscordChannel:
+    def __init__(self, channel_id, guild):
+        self.id = channel_id; self.guild = guild
+        self.sent_count = 0; self.sent_bytes = 0
+
+    async def send(self, content=None, **kwargs):
+        self.sent_count += 1
+        self.sent_bytes += len(content or "")
+
+    @contextlib.asynccontextmanager
+    async def typing(self):
+        yield
+
+class FakeDiscordMessage:
+    def __init__(self, message_id, author, channel, content):
+        self.id = message_id; self.author = author; self.channel = channel; self.guild = channel.guild
+        self.content = content; self.created_at = datetime.datetime.now(datetime.timezone.utc)
+
+class FakeDiscordClient:
+    def __init__(self, user):
+        self.user = user
+
+    def is_ready(self):
+        return False
+
+class FakeGeminiChunk:
+    def __init__(self, text, finish_reason=None):
+        self.text = text
+        self.candidates = [collections.namedtuple("Candidate", "finish_reason")(collections.namedtuple("FinishReason", "name")(finish_reason))] if finish_reason else None
+
+class FakeGeminiChatSession:
+    def __init__(self, model, history):
+        self.model = model; self.history = list(history)
+
+    async def send_message_async(self, content, stream=False):
+        return self._stream(content)
+
+    async def _stream(self, content):
+        # Replay: the prompt's first word selects a captured response shape (first chunk delay, chunks, delay per chunk)
+        plan = self.model.response_plans.get(str(content).split(' ', 1)[0])
+        first_delay, chunk_count, chunk_delay = plan or (self.model.chunk_delay, self.model.chunk_count, self.model.chunk_delay)
+        chunk_tokens = max(1, len(self.model.chunk_text) // 4) # ~4 chars/token
+        if self.model.max_output_tokens: chunk_count = min(chunk_count, max(1, self.model.max_output_tokens // chunk_tokens)) # Profile output cap
+        for i in range(chunk_count):
+            delay = first_delay if i == 0 else chunk_delay
+            if delay: await asyncio.sleep(delay)
+            else: await asyncio.sleep(0) # Yield like a real network read would
+            capped = i == chunk_count - 1 and self.model.max_output_tokens and (i + 1) * chunk_tokens >= self.model.max_output_tokens
+            yield FakeGeminiChunk(self.model.chunk_text, 'MAX_TOKENS' if capped else None)
+
+class FakeGeminiModel:
+    def __init__(self, chunk_count=20, chunk_size=80, chunk_delay=0.0, max_output_tokens=0, response_plans=None):
+        self.chunk_count = chunk_count; self.chunk_text = ("x" * (chunk_size - 1)) + "\n"; self.chunk_delay = chunk_delay
+        self.max_output_tokens = max_output_tokens # Like a generation profile's cap (0 = none); ends with finish reason MAX_TOKENS
+        self.response_plans = response_plans if response_plans is not None else {} # Prompt first word -> (first_chunk_delay, chunk_count, chunk_delay); see run_replay
+
+    def start_chat(self, history=None):
+        return FakeGeminiChatSession(self, history or [])
+
+    async def count_tokens_async(self, contents):
+        await asyncio.sleep(self.chunk_delay)
+        return collections.namedtuple("CountTokensResponse", "total_tokens")(len(str(contents)) // 4)
+
+def build_benchmark_events(event_count, mention_ratio=0.1, user_count=25, channel_count=5, seed=1234):
+    """Builds a deterministic event mix: mostly ignored chatter plus mentions that stream a response."""
+    rng = random.Random(seed)
+    bot_user = FakeDiscordUser(1000, APP_NAME, bot=True)
+    guild = FakeDiscordGuild(1)
+    channels = [FakeDiscordChannel(2000 + i, guild) for i in range(channel_count)]
+    users = [FakeDiscordUser(3000 + i, f"user{i}") for i in range(user_count)]
+    events = []
+    for i in range(event_count):
+        author = rng.choice(users); channel = rng.choice(channels)
+        if rng.random() < mention_ratio:
+            content = f"<@{bot_user.id}> benchmark question {i}"
+        else:
+            content = f"ordinary chatter {i} " * rng.randint(1, 8)
+        events.append(FakeDiscordMessage(10_000 + i, author, channel, content))
+    return bot_user, channels, events
+
+async def run_benchmark_events(events):
+    """Dispatches each event as its own task (as discord.py does) and waits for all of them."""
+    start = time.perf_counter()
+    await asyncio.gather(*(asyncio.create_task(on_message(message)) for message in events))
+    return time.perf_counter() - start
+
+def run_loop_benchmark(event_count):
+    """Compares the available event loop engines on the synthetic event mix. Returns exit code."""
+    global config, discord_client, gemini_model, conversations
+    config = {'AUTHOR_DISCORD_ID': None, 'GEMINI_MODEL_NAME': 'benchmark-fake',
+              'CONVERSATION_TIMEOUT_SECONDS': 3600, 'CONVERSATION_TIMEOUT_DELTA': timedelta(seconds=3600)}
+    gemini_model = FakeGeminiModel()
+    saved_level = logger.level; logger.setLevel(logging.WARNING) # Keep log I/O out of the measurement
+    print(f"Event mix: {event_count} events, ~10% mentions streaming {gemini_model.chunk_count} chunks each.")
+    print(f"{'loop':<10} {'wall (s)':>10} {'events/s':>12} {'sends':>8}")
+    try:
+        for loop_name in EVENT_LOOP_CHOICES:
+            if loop_name == 'uvloop' and uvloop is None:
+                print(f"{loop_name:<10} {'(not installed)':>10}"); continue
+            loop, active_name = create_event_loop(loop_name)
+            asyncio.set_event_loop(loop)
+            try:
+                bot_user, channels, events = build_benchmark_events(event_count)
+                discord_client = FakeDiscordClient(bot_user); conversations = {}; chat_sessions.clear()
+                elapsed = loop.run_until_complete(run_benchmark_events(events))
+            finally:
+                shutdown_event_loop(loop)
+            sends = sum(c.sent_count for c in channels)
+            print(f"{active_name:<10} {elapsed:>10.3f} {event_count / elapsed:>12.0f} {sends:>8}")
+    finally:
+        logger.setLevel(saved_level)
+    return 0
+
+def load_capture(path):
+    """Reads a traffic capture (CAPTURE_FILE and its rotated .1, .2, ... files) into a time-ordered list of events, skipping malformed lines."""
+    events = []
+    backups = [p for p in glob.glob(glob.escape(path) + '.*') if p[len(path) + 1:].isdigit()] # Oldest has the highest number
+    for capture_path in sorted(backups, key=lambda p: int(p[len(path) + 1:]), reverse=True) + [path]:
+        with open(capture_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                    if isinstance(event, dict) and 't' in event and 'e' in event: events.append(event)
+                except ValueError:
+                    continue
+    events.sort(key=lambda event: event['t'])
+    return events
+
+def build_replay(events, speed, bot_user, chunk_size=80):
+    """Turns captured events into (offset_seconds, kind, payload) actions on fake Discord objects, plus Gemini response plans."""
+    guild = FakeDiscordGuild(1); channels = {}; users = {}; plans = {}
+    replies = {event['id']: event for event in events if event['e'] == 'reply' and 'id' in event}
+    scale = (1.0 / speed) if speed else 0.0
+    actions = []; start = events[0]['t'] if events else 0.0; messages = {}; prompts = {} # Prompt token -> content of its first occurrence
+    for index, event in enumerate(events):
+        offset = (event['t'] - start) * scale
+        if event['e'] == 'msg':
+            channel = channels.setdefault(event.get('c'), FakeDiscordChannel(2000 + len(channels), guild))
+            author = users.setdefault(event.get('u'), FakeDiscordUser(3000 + len(users), f"user{len(users)}"))
+            length = event.get('n', 0); command = event.get('cmd')
+            # Captured prompt/man page hashes make repeats identical again, so the response and man caches can hit
+            token = f"m{event['k']}" if command == 'man' and event.get('k') else f"p{event['p']}" if event.get('p') else f"r{index}"
+            if command is None: content = "x" * max(1, length) # Chatter the bot ignores
+            elif command in ('botsnack', 'help'): content = f"<@{bot_user.id}> {command}"
+            elif command == 'empty': content = f"<@{bot_user.id}>"
+            elif command == 'man': content = f"<@{bot_user.id}> man {token}"
+            elif token in prompts: content = prompts[token]
+            else:
+                prefix = f"<@{bot_user.id}> " + ("summarize " if command == 'summarize' else "") + token
+                content = prompts[token] = prefix + " " + "x" * max(0, length - len(prefix) - 1)
+            reply = replies.get(event.get('id'))
+            if reply is not None and (reply.get('src') in ('gemini', 'gemini_error') or reply.get('ttft')): # Recreate the captured response shape
+                first_chunk = (reply.get('ttft') or 0) / 1000.0
+                chunk_count = max(1, reply.get('n', 0) // chunk_size)
+                generation_ms = reply.get('gen') or reply.get('ms', 0) # Cancelled streams ran until the cancel
+                stream_seconds = max(0.0, (generation_ms - (reply.get('ttft') or 0)) / 1000.0)
+                plans.setdefault(token, (first_chunk * scale, chunk_count, stream_seconds * scale / chunk_count)) # First captured shape per prompt
+            message = FakeDiscordMessage(10_000 + index, author, channel, content)
+            messages[event.get('id')] = message
+            actions.append((offset, 'msg', message))
+        elif event['e'] in ('del', 'edit') and event.get('id') in messages:
+            before = messages[event['id']]
+            if event['e'] == 'del':
+                actions.append((offset, 'del', before))
+            else:
+                after = FakeDiscordMessage(before.id, before.author, before.channel, before.content + " (edited)")
+                messages[event['id']] = after
+                actions.append((offset, 'edit', (before, after)))
+    return actions, list(channels.values()), plans
+
+async def run_replay_actions(actions):
+    """Dispatches replay actions at their offsets (as discord.py would) and returns (wall seconds, mention latencies)."""
+    loop = asyncio.get_running_loop(); start = loop.time(); tasks = []; latencies = []
+
+    async def timed(coro, is_mention):
+        started = loop.time()
+        await coro
+        if is_mention: latencies.append(loop.time() - started)
+
+    for offset, kind, payload in actions:
+        delay = offset - (loop.time() - start)
+        if delay > 0: await asyncio.sleep(delay)
+        if kind == 'msg': tasks.append(asyncio.create_task(timed(on_message(payload), discord_client.user.mentioned_in(payload))))
+        elif kind == 'del': tasks.append(asyncio.create_task(on_message_delete(payload)))
+        else: tasks.append(asyncio.create_task(on_message_edit(*payload)))
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return loop.time() - start, latencies
+
+def run_replay(path, speed, loop_name='asyncio', config_path=None):
+    """Replays a traffic capture through the bot with fake Discord/Gemini stand-ins. Returns exit code.
+
+    Tuning keys (debounce, caches, attachment threshold, profiles, breaker, lanes) come from config_path,
+    or the defaults. Host man pages, tracing and capture stay off so runs are comparable.
+    """
+    global config, discord_client, gemini_model, conversations
+    try:
+        events = load_capture(path)
+    except OSError as e:
+        print(f"Error: cannot read capture {path}: {e}", file=sys.stderr); return 1
+    if not events:
+        print(f"Error: no events in {path}", file=sys.stderr); return 1
+    config = load_configuration(config_path, require_credentials=False)
+    apply_runtime_configuration()
+    conversations = {}; metrics.clear()
+    for cache in (chat_sessions, man_page_cache, man_key_aliases, response_cache): cache.clear()
+    bot_user = FakeDiscordUser(1000, APP_NAME, bot=True); discord_client = FakeDiscordClient(bot_user)
+    actions, channels, response_plans = build_replay(events, speed, bot_user)
+    gemini_models.update({profile: FakeGeminiModel(max_output_tokens=settings['max_output_tokens'], response_plans=response_plans)
+                          for profile, settings in config['GENERATION_PROFILES'].items()})
+    gemini_model = gemini_models['general']
+    span = events[-1]['t'] - events[0]['t']
+    print(f"Replaying {len(actions)} event(s) spanning {span:.1f}s at {f'{speed:g}x' if speed else 'max'} speed "
+          f"({len(gemini_model.response_plans)} Gemini response shape(s)).")
+    saved_level = logger.level; logger.setLevel(logging.WARNING) # Keep log I/O out of the measurement
+    loop, active_name = create_event_loop(loop_name)
+    asyncio.set_event_loop(loop)
+    try:
+        elapsed, latencies = loop.run_until_complete(run_replay_actions(actions))
+    finally:
+        shutdown_event_loop(loop); logger.setLevel(saved_level)
+    latencies.sort()
+    def percentile(q): return latencies[min(len(latencies) - 1, int(len(latencies) * q))] if latencies else 0.0
+    print(f"Loop: {active_name}  wall: {elapsed:.2f}s  events/s: {len(actions) / elapsed if elapsed else 0:.0f}  "
+          f"sends: {sum(c.sent_count for c in channels)}")
+    print(f"Mentions: {len(latencies)}  latency p50: {percentile(0.5):.3f}s  p90: {percentile(0.9):.3f}s  max: {percentile(1.0):.3f}s")
+    print(f"Caches: {'; '.join(f'{cache.name} {cache.stats()}' for cache in (response_cache, man_page_cache))}")
+    print(f"Counters: {dict(metrics)}")
+    return 0
+
 # --- Main Execution ---
+def apply_runtime_configuration():
+    """Sizes the caches and sets up the circuit breaker from config (shared by the bot and --replay)."""
+    # Live chat session cache
+    chat_sessions.max_entries = config['CHAT_SESSION_CACHE_SIZE']
+    chat_sessions.max_bytes = config['CHAT_SESSION_CACHE_MAX_BYTES']
+
+    # Opt-in response cache (a zero-sized cache stores nothing)
+    if config['RESPONSE_CACHE']:
+        response_cache.max_entries = config['RESPONSE_CACHE_SIZE']
+        response_cache.max_bytes = config['RESPONSE_CACHE_MAX_BYTES']
+        response_cache.ttl_seconds = config['RESPONSE_CACHE_TTL_SECONDS']
+
+    # Man page cache
+    man_page_cache.max_entries = config['MAN_CACHE_SIZE']
+    man_page_cache.max_bytes = config['MAN_CACHE_MAX_BYTES']
+
+    # Gemini circuit breaker
+    gemini_breaker.enabled = config['GEMINI_BREAKER']
+    gemini_breaker.configure(config['GEMINI_BREAKER_WINDOW'], config['GEMINI_BREAKER_MIN_CALLS'], config['GEMINI_BREAKER_FAILURE_RATE'],
+                             config['GEMINI_BREAKER_OPEN_SECONDS'], config['GEMINI_BREAKER_PROBE_INTERVAL_SECONDS'], config['GEMINI_BREAKER_PROBE_MAX_AGE_SECONDS'])
+    gemini_breaker.on_change = on_gemini_breaker_change
+
 def main():
-    global config, discord_client, gemini_model, APP_NAME # Allow modification
+    global config, discord_client, gemini_model, APP_NAME, man_binary, local_man_dirs, event_loop_name # Allow modification
 
     parser = argparse.ArgumentParser(description=f"{APP_NAME} - Discord bot using Google Gemini.", prog=APP_NAME)
-    parser.add_argument('--config', default=DEFAULT_ENV_FILE, help=f"Path to .env config file (default: {DEFAULT_ENV_FILE})")
+    parser.add_argument('--config', default=None, help=f"Path to .env config file (default: {DEFAULT_ENV_FILE}; with --replay: tuning keys only, no default file)")
     parser.add_argument('--pidfile', default=DEFAULT_PID_PATH, help=f"Path to PID file (default: {DEFAULT_PID_PATH})")
     parser.add_argument('--log-level', default='INFO', choices=['DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'], help="Logging level (default: INFO)")
     parser.add_argument('--foreground', '-f', action='store_true', help="Run in foreground with console logging (ignores PID file).")
+    parser.add_argument('--loop', choices=EVENT_LOOP_CHOICES, default=None, help="Event loop engine (default: EVENT_LOOP from config, else asyncio). Falls back to asyncio if uvloop is not installed.")
+    parser.add_argument('--replay', metavar='CAPTURE', default=None, help="Replay a traffic capture (CAPTURE_FILE) offline through fake Discord/Gemini objects and exit.")
+    parser.add_argument('--replay-speed', type=float, default=1.0, metavar='N', help="Replay speed: 1 = real time, N = N times faster, 0 = as fast as possible (default: 1).")
+    parser.add_argument('--benchmark-loop', type=int, metavar='EVENTS', default=None, help="Run an offline benchmark of the event loop engines on a synthetic event mix and exit.")
     args = parser.parse_args()
 
+    # Offline benchmark needs no configuration, credentials or PID file
+    if args.benchmark_loop is not None:
+        setup_logging(log_level_str=args.log_level, log_to_console=True)
+        sys.exit(run_loop_benchmark(max(1, args.benchmark_loop)))
+    if args.replay is not None:
+        setup_logging(log_level_str=args.log_level, log_to_console=True)
+        sys.exit(run_replay(args.replay, max(0.0, args.replay_speed), args.loop or 'asyncio', args.config))
+
     # Setup logging first
     setup_logging(log_level_str=args.log_level, log_to_console=args.foreground)
     logger.info(f"--- Starting {APP_NAME} bot ---")
 
     # Load configuration
     try:
-        config = load_configuration(args.config)
+        config = load_configuration(args.config or DEFAULT_ENV_FILE)
     except SystemExit:
          raise # Propagate exit from config loading
     except Exception as e:
@@ -622,11 +2316,37 @@ def main():
             if not args.foreground:
                 logger.info(f"Acquired PID lock file: {args.pidfile}")
 
+            # Start the trace exporter thread (spans never block the event loop)
+            if config['TRACE_FILE']:
+                tracer.configure(config['TRACE_FILE'], config['TRACE_SAMPLE_RATE'], config['TRACE_MAX_BYTES'], config['TRACE_BACKUP_COUNT'])
+            if config['CAPTURE_FILE']:
+                capture.configure(config['CAPTURE_FILE'], config['CAPTURE_MAX_BYTES'], config['CAPTURE_BACKUP_COUNT'])
+
+            # Cache sizes and the circuit breaker
+            apply_runtime_configuration()
+
+            # Learned man page popularity (for prewarming)
+            load_man_request_stats(config['MAN_STATS_FILE'])
+
+            # Local man page provider (needs man(1) for rendering)
+            if config['MAN_LOCAL_PAGES']:
+                man_binary = shutil.which('man')
+                local_man_dirs = discover_manpath()
+                if man_binary and local_man_dirs:
+                    logger.info(f"Local man pages enabled: {':'.join(local_man_dirs)} (render concurrency {config['MAN_RENDER_CONCURRENCY']}).")
+                else:
+                    logger.warning(f"Local man pages unavailable (man binary: {man_binary or 'not found'}, man dirs: {len(local_man_dirs)}). Using Gemini only.")
+            else:
+                logger.info("Local man pages disabled (MAN_LOCAL_PAGES=false).")
+
             # Initialize Gemini
             try:
                 logger.info(f"Initializing Gemini: {config['GEMINI_MODEL_NAME']}")
-                genai.configure(api_key=config['GEMINI_API_KEY'])
-                gemini_model = genai.GenerativeModel(config['GEMINI_MODEL_NAME'])
+                # Connection pool size and gRPC keepalive options are not exposed by genai.configure; idle keepalives are sent by gemini_keepalive()
+                genai.configure(api_key=config['GEMINI_API_KEY'], transport=config['GEMINI_TRANSPORT'])
+                gemini_models.update({profile: build_profile_model(config['GEMINI_MODEL_NAME'], settings)
+                                      for profile, settings in config['GENERATION_PROFILES'].items()})
+                gemini_model = gemini_models['general']
                 logger.info("Gemini initialized.")
             except Exception as e:
                 logger.critical(f"Gemini Init Error: {e}", exc_info=True)
@@ -640,16 +2360,28 @@ def main():
                 discord_client = discord.Client(intents=intents, heartbeat_timeout=90)
                 discord_client.event(on_ready)
                 discord_client.event(on_message)
+                discord_client.event(on_message_delete)
+                discord_client.event(on_message_edit)
                 logger.info("Discord client initialized.")
             except Exception as e:
                  logger.critical(f"Discord Init Error: {e}", exc_info=True)
                  raise # Raise to exit main try block
 
+            # Create the event loop up front so signal handlers attach to the loop that runs the bot
+            loop, loop_name = create_event_loop(args.loop or config['EVENT_LOOP'])
+            asyncio.set_event_loop(loop); event_loop_name = loop_name
+            logger.info(f"Event loop engine: {loop_name} ({type(loop).__module__}.{type(loop).__name__})")
+
+            # Diagnostics dumps go next to the PID file unless configured otherwise
+            if not config['DIAGNOSTICS_DIR']: config['DIAGNOSTICS_DIR'] = os.path.dirname(os.path.abspath(args.pidfile))
+            if config['TRACEMALLOC_AT_STARTUP']: toggle_tracemalloc()
+
             # Setup Signal Handling (Best effort)
             try:
-                 loop = asyncio.get_event_loop()
                  loop.add_signal_handler(signal.SIGTERM, lambda: asyncio.create_task(cleanup_shutdown()))
                  loop.add_signal_handler(signal.SIGINT, lambda: asyncio.create_task(cleanup_shutdown()))
+                 loop.add_signal_handler(signal.SIGUSR1, start_diagnostics_dump)
+                 loop.add_signal_handler(signal.SIGUSR2, toggle_tracemalloc)
                  logger.info("Signal handlers registered.")
             except NotImplementedError:
                  logger.warning("Signal handlers not supported on this platform (e.g., Windows).")
@@ -660,11 +2392,10 @@ def main():
 
             # Start the bot's main blocking run loop
             logger.info(f"Starting {APP_NAME} Discord bot run loop...")
-            discord_client.run(
-                config['DISCORD_BOT_TOKEN'],
-                log_handler=None, # Use our configured logger
-                log_level=logging.INFO # Set discord.py's internal logger level
-            )
+            try:
+                loop.run_until_complete(run_discord_client(config['DISCORD_BOT_TOKEN']))
+            finally:
+                shutdown_event_loop(loop)
             # This part is reached only upon clean shutdown (e.g., client.close() called)
             logger.info("Discord client run loop finished normally.")
 
@@ -689,83 +2420,12 @@ def main():
         main_exit_code = 1
     finally:
         # Context manager handles PID release automatically on exit/exception
+        tracer.shutdown() # Flush any queued spans
+        capture.shutdown() # Flush any queued capture events
+        if config: save_man_request_stats(config.get('MAN_STATS_FILE'))
         logger.info(f"{APP_NAME} shutdown sequence finished. Exiting code {main_exit_code}.")
         sys.exit(main_exit_code)
 
 
 if __name__ == "__main__":
     main()
-EOF
-msg_pass "yui_bot.py written."
-
-# --- Final Diagnostics ---
-msg_info "Running final checks..."
-FINAL_CHECK_FAIL=0
-
-# Check Python syntax
-msg_info "Checking Python syntax..."
-if ! python3 -m py_compile yui_bot.py; then
-    msg_error "Syntax error in yui_bot.py"
-    FINAL_CHECK_FAIL=1
-fi
-if ! python3 -m py_compile configure-yui-bot.py; then
-     msg_error "Syntax error in configure-yui-bot.py"
-     FINAL_CHECK_FAIL=1
-fi
-
-# Check Shell syntax
-msg_info "Checking shell script syntax..."
-if ! bash -n test-project.sh; then
-    msg_error "Syntax error in test-project.sh"
-    FINAL_CHECK_FAIL=1
-fi
-if ! bash -n service/yui-bot.initd.in; then
-     msg_error "Syntax error in service/yui-bot.initd.in"
-     FINAL_CHECK_FAIL=1
-fi
-
-# Check Autotools generation (autoreconf only, configure/make checked by smokecheck)
-msg_info "Running 'autoreconf -fi' to check configure.ac/Makefile.am..."
-set +e
-autoreconf -fi > /dev/null 2>&1
-AUTORECONF_STATUS=$?
-set -e
-if [ $AUTORECONF_STATUS -ne 0 ]; then
-    msg_error "autoreconf -fi failed! Check configure.ac and Makefile.am."
-    FINAL_CHECK_FAIL=1
-fi
-
-# Run make smokecheck (includes distcheck)
-msg_info "Running 'make smokecheck' (this includes make distcheck and may take a while)..."
-set +e
-# Need to configure first before make smokecheck
-if [ $AUTORECONF_STATUS -eq 0 ]; then
-    ./configure --prefix=/usr --quiet
-    if [ $? -eq 0 ]; then
-        make smokecheck
-        SMOKECHECK_STATUS=$?
-    else
-        msg_error "./configure failed before smokecheck."
-        SMOKECHECK_STATUS=1 # Mark as failed
-    fi
-else
-    msg_error "Skipping smokecheck because autoreconf failed."
-    SMOKECHECK_STATUS=1 # Mark as failed
-fi
-set -e
-
-if [ $SMOKECHECK_STATUS -ne 0 ]; then
-    msg_error "'make smokecheck' failed! Review output and logs."
-    FINAL_CHECK_FAIL=1
-fi
-
-echo "---"
-if [ $FINAL_CHECK_FAIL -eq 0 ]; then
-    msg_pass "All file updates applied and basic diagnostic checks passed."
-    msg_info "The codebase should be in a consistent, buildable state (v1.3.21)."
-else
-    msg_error "Some files were updated, but subsequent diagnostic checks failed. Please review errors above."
-    exit 1
-fi
-
-exit 0